@@ -0,0 +1,128 @@
+#!/opt/datafax/PHRI/python27
+#
+# Copyright 2019, Population Health Research Institute
+# Copyright 2019, Martin Renters
+#
+# This file is part of the DataFax Toolkit.
+#
+# The DataFax Toolkit is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# The DataFax Toolkit is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with The DataFax Toolkit.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+#####################################################################
+# Time closeout's audit by field section for one heavily edited
+# record, on a synthetic plate. No study or database is needed.
+#
+#   bench_field_audit.py --fields 200 --ops 10000
+#####################################################################
+
+from __future__ import print_function
+
+import getopt
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import datafax
+from datafax import audittrail
+import closeout
+
+#####################################################################
+# A study with one plate of the requested number of fields
+#####################################################################
+def make_study(fields):
+    module_fields = []
+    field_refs = []
+    for n in range(1, fields+1):
+        module_fields.append({'id': n, 'name': 'f{0}'.format(n),
+            'type': 'String', 'description': 'Field {0}'.format(n)})
+        field_refs.append({'id': 10000+n, 'fieldId': n, 'number': n,
+            'name': 'f{0}'.format(n), 'type': 'String',
+            'description': 'Field {0}'.format(n),
+            'rects': [{'x': 10, 'y': 10+n*12, 'w': 100, 'h': 10}]})
+    setup = {'study': {
+        'modules': [{'id': 1, 'name': 'bench', 'fields': module_fields}],
+        'plates': [{'number': 1, 'moduleRefs': [{'id': 1, 'moduleId': 1,
+            'fieldRefs': field_refs}]}]}}
+    study = datafax.Study()
+    study.loadSetup(json.dumps(setup))
+    return study
+
+#####################################################################
+# Audit transactions spread over the fields, with a few for the whole
+# record (funiqueid 0), which are listed under every field
+#####################################################################
+def make_ops(rng, fields, count, record_ops):
+    record_at = set(rng.sample(range(count), record_ops))
+    ops = []
+    for i in range(count):
+        if i in record_at:
+            funiqueid = 0
+        else:
+            funiqueid = 10000 + rng.randint(1, fields)
+        ops.append(audittrail.AuditTxn('user{0}'.format(rng.randint(1, 5)),
+            '2019/01/{0:02d}'.format(i % 28 + 1), '12:00:00', funiqueid, 0,
+            'Field', ['Changed Value: <b>{0}</b>'.format(i)]))
+    return ops
+
+def main():
+    fields = 200
+    count = 10000
+    record_ops = 5
+    repeat = 3
+
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], '',
+            ['fields=', 'ops=', 'record-ops=', 'repeat='])
+    except getopt.GetoptError, err:
+        print(err)
+        sys.exit(2)
+
+    for o, a in opts:
+        if o == '--fields':
+            fields = int(a)
+        if o == '--ops':
+            count = int(a)
+        if o == '--record-ops':
+            record_ops = int(a)
+        if o == '--repeat':
+            repeat = int(a)
+
+    study = make_study(fields)
+    auditOps = make_ops(random.Random(1), fields, count, record_ops)
+    tmpdir = tempfile.mkdtemp()
+    try:
+        best = None
+        for i in range(repeat):
+            pdf = closeout.DFpdf(tmpdir, 'bench', None, study, False, {},
+                    None, None, None, None, None, None, False, True, 10, 12,
+                    False, False, 0, 0)
+            start = time.time()
+            pdf.outputFieldAudit(6.4*72, 1, 0, 1, auditOps)
+            elapsed = time.time() - start
+            if best is None or elapsed < best:
+                best = elapsed
+    finally:
+        shutil.rmtree(tmpdir)
+
+    print('{0} fields, {1} audit operations: {2:.3f}s'.format(fields, count,
+        best))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,152 @@
+#!/opt/datafax/PHRI/python27
+#
+# Copyright 2019, Population Health Research Institute
+# Copyright 2019, Martin Renters
+#
+# This file is part of the DataFax Toolkit.
+#
+# The DataFax Toolkit is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# The DataFax Toolkit is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with The DataFax Toolkit.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+#####################################################################
+# Time laying out and drawing a chronological audit listing as a
+# Table of Paragraphs and as closeout's ListingTable. No study or
+# database is needed.
+#
+#   bench_listing.py --rows 5000 --ops 2
+#####################################################################
+
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import getopt
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from reportlab.lib.colors import lightgrey
+from reportlab.lib.pagesizes import letter
+from reportlab.lib.units import inch
+from reportlab.platypus import Paragraph, Table, TableStyle, \
+    SimpleDocTemplate
+import closeout
+
+WORDS = ['visit', 'dose', 'mg', 'daily', 'reviewed', 'entry', 'error',
+    'corrected', 'per', 'source', 'document', 'site', 'query', 'resolved']
+
+#####################################################################
+# Audit rows as outputAudit lists them: field, description and the
+# operations, with the markup audittrail gives them
+#####################################################################
+def make_rows(rng, count, ops):
+    rows = []
+    for i in range(count):
+        fnum = rng.randint(1, 60)
+        changes = []
+        for j in range(ops):
+            old = ' '.join(rng.sample(WORDS, rng.randint(1, 3)))
+            new = ' '.join(rng.sample(WORDS, rng.randint(1, 8)))
+            changes.append('Changed Value: <b>{0} \u2192 {1}</b>'.format(
+                old, new))
+        changes.append('Reason Text: <i>{0}</i>'.format(
+            ' '.join(rng.sample(WORDS, rng.randint(2, 10)))))
+        rows.append(('{0}.'.format(fnum),
+            'Field {0} &amp; description'.format(fnum), changes))
+    return rows
+
+def paragraph_table(rows, width, styles):
+    styleN = styles['default']
+    styleI = styles['indented']
+    data = [[
+        Paragraph('<para alignment="right"><b>Field</b></para>', styleN),
+        Paragraph('<b>Description</b>', styleN),
+        Paragraph('<b>Operation</b>', styleN)]]
+    for (fnum, desc, ops) in rows:
+        data.append([
+            Paragraph('<para alignment="right">{0}</para>'.format(fnum),
+                styleN),
+            Paragraph(desc, styleN),
+            [Paragraph(o, styleI) for o in ops]])
+    table = Table(data, colWidths=[0.1*width, 0.3*width, 0.6*width],
+        splitByRow=1, repeatRows=1, hAlign='LEFT')
+    table.setStyle(TableStyle([
+        ('VALIGN', (0,0), (-1, -1), 'TOP'),
+        ('LINEABOVE', (0,0), (-1, -1), 1, lightgrey)]))
+    return table
+
+def listing_table(rows, width, styles):
+    return closeout.ListingTable(
+        [0.1*width, 0.3*width, 0.6*width],
+        (closeout.TA_RIGHT, closeout.TA_LEFT, closeout.TA_LEFT),
+        ['<b>Field</b>', '<b>Description</b>', '<b>Operation</b>'],
+        [closeout.ListingRow([fnum, desc, ops], None, None)
+            for (fnum, desc, ops) in rows],
+        styles['default'], styles['indented'])
+
+#####################################################################
+# Best time to make the flowable and build it into a document
+#####################################################################
+def time_build(make, rows, path, repeat):
+    styles = closeout.stylesheet(10, 12)
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        doc = SimpleDocTemplate(path, pagesize=letter)
+        doc.build([make(rows, 6.4*inch, styles)])
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return (best, doc.page)
+
+def main():
+    count = 5000
+    ops = 2
+    repeat = 3
+
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], '',
+            ['rows=', 'ops=', 'repeat='])
+    except getopt.GetoptError, err:
+        print(err)
+        sys.exit(2)
+
+    for o, a in opts:
+        if o == '--rows':
+            count = int(a)
+        if o == '--ops':
+            ops = int(a)
+        if o == '--repeat':
+            repeat = int(a)
+
+    rows = make_rows(random.Random(1), count, ops)
+    tmpdir = tempfile.mkdtemp()
+    try:
+        (table, table_pages) = time_build(paragraph_table, rows,
+                os.path.join(tmpdir, 'table.pdf'), repeat)
+        (listing, listing_pages) = time_build(listing_table, rows,
+                os.path.join(tmpdir, 'listing.pdf'), repeat)
+    finally:
+        shutil.rmtree(tmpdir)
+
+    print('{0} rows: Table {1:.3f}s ({2} pages), ListingTable {3:.3f}s '
+        '({4} pages), {5:.1f}x'.format(count, table, table_pages, listing,
+        listing_pages, table/listing))
+
+if __name__ == "__main__":
+    main()
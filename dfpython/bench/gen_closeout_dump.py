@@ -0,0 +1,193 @@
+#!/opt/datafax/PHRI/python27
+#
+# Copyright 2019, Population Health Research Institute
+# Copyright 2019, Martin Renters
+#
+# This file is part of the DataFax Toolkit.
+#
+# The DataFax Toolkit is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# The DataFax Toolkit is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with The DataFax Toolkit.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+#####################################################################
+# Generate a synthetic study dump for make_closeout_db --source, so
+# database builds can be timed without a DataFax server. The same
+# seed always produces the same dump.
+#
+#   gen_closeout_dump.py -o dump --patients 1000
+#   make_closeout_db.py -s 254 -d bench.db --source dump
+#####################################################################
+
+from __future__ import print_function
+
+import getopt
+import gzip
+import os
+import random
+import sys
+
+STUDY = 254
+WHO = ['alice', 'bob', 'carol', 'dave', 'erin', 'frank']
+CODES = [('1', 'Missing value'), ('2', 'Illegal value'),
+        ('3', 'Inconsistent value'), ('4', 'Illegible value')]
+REASONS = ['', 'Transcription error', 'Data entry error',
+        'Updated per source document']
+
+#####################################################################
+# Open a dump file, compressed if requested
+#####################################################################
+def open_dump(directory, name, compress):
+    path = os.path.join(directory, name)
+    if compress:
+        return gzip.open(path + '.gz', 'wb')
+    return open(path, 'wb')
+
+#####################################################################
+# Generate a field value, some of them Latin-1 encoded as older
+# DataFax studies often are
+#####################################################################
+def value(rng, latin1):
+    if rng.random() < latin1:
+        return b'caf\xe9 ' + str(rng.randint(0, 999)).encode('ascii')
+    return b'v' + str(rng.randint(0, 99999)).encode('ascii')
+
+#####################################################################
+# Format an audit line in DFaudittrace -N -q -r layout
+#####################################################################
+def audit_line(op, stamp, who, pid, visit, plate, uniqueid, metafnum, status,
+        code, oldval, newval, fnum, fdesc):
+    (date, time) = stamp
+    return b'|'.join([op, date, time, who, str(pid), str(visit), str(plate),
+        str(uniqueid), str(metafnum), str(status), b'1', b'7', code[0],
+        code[1], oldval, newval, str(fnum), fdesc, b'', b'']) + b'\n'
+
+def timestamp(rng, day):
+    return ('{0:04d}{1:02d}{2:02d}'.format(2015 + day // 336,
+            day // 28 % 12 + 1, day % 28 + 1),
+            '{0:02d}{1:02d}{2:02d}'.format(rng.randint(7, 18),
+            rng.randint(0, 59), rng.randint(0, 59)))
+
+def main():
+    directory = None
+    patients = 100
+    visits = 10
+    plates = 5
+    fields = 20
+    changes = 0.1
+    latin1 = 0.01
+    seed = 1
+    compress = False
+
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'o:',
+            ['output=', 'patients=', 'visits=', 'plates=', 'fields=',
+             'changes=', 'latin1=', 'seed=', 'gzip'])
+    except getopt.GetoptError, err:
+        print(err)
+        sys.exit(2)
+
+    for o, a in opts:
+        if o in ('-o', '--output'):
+            directory = a
+        if o == '--patients':
+            patients = int(a)
+        if o == '--visits':
+            visits = int(a)
+        if o == '--plates':
+            plates = int(a)
+        if o == '--fields':
+            fields = int(a)
+        if o == '--changes':
+            changes = float(a)
+        if o == '--latin1':
+            latin1 = float(a)
+        if o == '--seed':
+            seed = int(a)
+        if o == '--gzip':
+            compress = True
+
+    if directory is None:
+        print('No output directory specified')
+        sys.exit(2)
+
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    rng = random.Random(seed)
+
+    with open_dump(directory, 'plates', compress) as f:
+        f.write(b' '.join([str(p) for p in range(1, plates+1)]) + b'\n')
+
+    plate_files = [open_dump(directory, 'plate{0:03d}'.format(p), compress) \
+            for p in range(1, plates+1)]
+    audit = open_dump(directory, 'audit', compress)
+
+    records = 0
+    audit_records = 0
+    for pid in range(1001, 1001+patients):
+        for visit in range(visits):
+            for plate in range(1, plates+1):
+                day = visit * 7 + rng.randint(0, 6)
+                stamp = timestamp(rng, day)
+                who = rng.choice(WHO)
+                raster = '{0:04d}/{1:07d}'.format(1901 + day // 336 * 100,
+                        rng.randint(0, 9999999))
+                values = [value(rng, latin1) for i in range(fields)]
+                status = 1 if rng.random() > 0.02 else 2
+                plate_files[plate-1].write(b'|'.join([str(status), b'1',
+                    raster, str(STUDY), str(plate), str(visit), str(pid)] + \
+                    values) + b'\n')
+                records += 1
+
+                if rng.random() < 0.05:
+                    plate_files[plate-1].write(b'|'.join([b'4', b'1',
+                        '{0:04d}/{1:07d}'.format(1901, rng.randint(0, 9999999)),
+                        str(STUDY), str(plate), str(visit), str(pid)]) + b'\n')
+
+                # Record creation
+                audit.write(audit_line(b'N', stamp, who, pid, visit, plate,
+                    0, 0, status, (b'', b''), b'', raster, 0, b'Raster'))
+                for fnum, v in enumerate(values, 8):
+                    audit.write(audit_line(b'N', stamp, who, pid, visit, plate,
+                        0, 10000 + fnum, status, (b'', b''), b'', v, fnum,
+                        'Field {0} of plate {1}'.format(fnum, plate)))
+                audit_records += len(values) + 1
+
+                # Later changes, with a QC note and a reason
+                for fnum, v in enumerate(values, 8):
+                    if rng.random() >= changes:
+                        continue
+                    day += rng.randint(1, 60)
+                    stamp = timestamp(rng, day)
+                    who = rng.choice(WHO)
+                    fdesc = 'Field {0} of plate {1}'.format(fnum, plate)
+                    uniqueid = 10000 + fnum
+                    audit.write(audit_line(b'N', stamp, who, pid, visit, plate,
+                        uniqueid, 1, status, rng.choice(CODES), b'', b'1',
+                        fnum, fdesc))
+                    audit.write(audit_line(b'C', stamp, who, pid, visit, plate,
+                        0, uniqueid, status, (b'', b''), value(rng, latin1), v,
+                        fnum, fdesc))
+                    audit.write(audit_line(b'N', stamp, who, pid, visit, plate,
+                        -uniqueid, 0, status, (b'', rng.choice(REASONS)), b'',
+                        b'', fnum, fdesc))
+                    audit_records += 3
+
+    for f in plate_files:
+        f.close()
+    audit.close()
+    print('Wrote {0} data records and {1} audit records to {2}'.format(
+        records, audit_records, directory))
+
+if __name__ == "__main__":
+    main()
@@ -33,28 +33,49 @@ from reportlab.lib.colors import red, blue, green, cyan, yellow, \
     magenta, orange, purple, black, white, darkgrey, darkslategrey, \
     lightgrey, darkblue, dimgrey, HexColor
 from reportlab.lib.pagesizes import letter, A4
+from reportlab.pdfbase import pdfmetrics
 from reportlab.lib.units import inch
 from reportlab.lib.styles import ParagraphStyle
-from reportlab.lib.enums import TA_LEFT, TA_CENTER
-from reportlab.platypus import Paragraph, Frame, Table, TableStyle, \
-    KeepTogether, Flowable, SimpleDocTemplate, PageBreak
+from reportlab.lib.enums import TA_LEFT, TA_CENTER, TA_RIGHT
+from reportlab.lib.fonts import tt2ps, ps2tt
+from reportlab.platypus import Paragraph, Frame, KeepTogether, Flowable, \
+    SimpleDocTemplate, PageBreak
 from reportlab.platypus.doctemplate import PageTemplate, BaseDocTemplate, \
     LayoutError
 from reportlab.platypus.tableofcontents import TableOfContents
 
-from pdfrw import PdfReader
+from pdfrw import PdfReader, PdfDict, PdfArray
 from pdfrw.buildxobj import pagexobj
 from pdfrw.toreportlab import makerl
 
-from collections import namedtuple
-
 import os
 import time
 import getopt
 import sys
+import multiprocessing
+import BaseHTTPServer
+import SocketServer
+import socket
+import stat
+from multiprocessing.pool import ThreadPool
+import weakref
+import hashlib
+import json
+import csv
+import math
+import atexit
+import shutil
+import tempfile
+import traceback
+from collections import deque, OrderedDict, namedtuple
+from itertools import groupby
+from heapq import merge
+from StringIO import StringIO
 import re
 import datafax
 import sqlite3
+from datafax import closeoutdb
+from datafax import audittrail
 import getpass
 from PIL import Image
 
@@ -181,16 +202,408 @@ class DFOutlines(Flowable):
 
         canvas.showOutline()
 
+##############################################################################
+# ListingTable - The field value and audit listings: fixed columns of text
+# under a header row, with a light grey line above each row, laid out as
+# a Table of Paragraphs would be. Paragraph's markup parser and Table's
+# layout dominate the time spent on audit heavy patients, so text is
+# measured with the font metrics and wrapped here instead. Only <b>, <i>
+# and the entities escapeString makes are understood; a cell with any
+# other markup is left to a Paragraph.
+#
+# A cell is a string, drawn in style, or a list of strings drawn one under
+# the other in list_style. A row may carry a bookmark, and an internal
+# link for its last cell. The header row is repeated when the table is
+# split across pages.
+##############################################################################
+ListingRow = namedtuple('ListingRow', 'cells, anchor, link')
+
+LISTING_PADDING = (6, 3)
+TEXT_WIDTH_CACHE = 100000
+SIMPLE_MARKUP = re.compile(r'<(/?)([bi])>|&(amp|lt|gt);')
+ENTITIES = {'amp': '&', 'lt': '<', 'gt': '>'}
+
+textWidths = {}
+
+def textWidth(text, font, size):
+    '''pdfmetrics.stringWidth, remembered'''
+    key = (text, font, size)
+    width = textWidths.get(key)
+    if width is None:
+        if len(textWidths) >= TEXT_WIDTH_CACHE:
+            textWidths.clear()
+        width = pdfmetrics.stringWidth(text, font, size)
+        textWidths[key] = width
+    return width
+
+def simpleRuns(text):
+    '''Split text into (bold, italic, text) runs, or None if it has any
+    markup besides <b>, <i>, &amp;, &lt; and &gt;. Entities are runs of
+    their own, as Paragraph makes them fragments of their own.'''
+    if '<' not in text and '&' not in text:
+        return [(False, False, text)]
+    runs = []
+    chunk = []
+    bold = italic = False
+    pos = 0
+    for m in SIMPLE_MARKUP.finditer(text):
+        plain = text[pos:m.start()]
+        if '<' in plain or '&' in plain:
+            return None
+        chunk.append(plain)
+        pos = m.end()
+        runs.append((bold, italic, ''.join(chunk)))
+        chunk = []
+        if m.group(3):
+            runs.append((bold, italic, ENTITIES[m.group(3)]))
+        elif m.group(2) == 'b':
+            bold = not m.group(1)
+        else:
+            italic = not m.group(1)
+    plain = text[pos:]
+    if '<' in plain or '&' in plain:
+        return None
+    chunk.append(plain)
+    runs.append((bold, italic, ''.join(chunk)))
+    return runs
+
+def wordWidth(word, size):
+    return sum(textWidth(t, f, size) for (f, t) in word)
+
+def splitWord(word, width, size):
+    '''Split a word, a list of (font, text), where it passes width'''
+    used = 0
+    for (i, (f, t)) in enumerate(word):
+        for (j, c) in enumerate(t):
+            used += textWidth(c, f, size)
+            if used > width:
+                head = word[:i] + ([(f, t[:j])] if j else [])
+                return (head, [(f, t[j:])] + word[i+1:])
+    return (word, [])
+
+def breakLines(runs, style, width, single):
+    '''Break runs of text into lines no wider than width, as Paragraph
+    would. A line is its width and a list of (font, text) pieces. single
+    is whether Paragraph would see the text as one fragment.'''
+    size = style.fontSize
+    family = ps2tt(style.fontName)[0]
+    words = []
+    joined = False
+    for (bold, italic, text) in runs:
+        parts = text.split()
+        if not parts:
+            joined = joined and not text
+            continue
+        font = tt2ps(family, bold, italic)
+        if joined and not text[0].isspace():
+            words[-1].append((font, parts.pop(0)))
+        words.extend([[(font, part)] for part in parts])
+        joined = not text[-1].isspace()
+
+    # Paragraph lets the spaces on a line shrink a little to fit, counting
+    # the space before the next word too when the text is one fragment
+    shrink = style.spaceShrinkage
+    restWidth = width - style.leftIndent - style.rightIndent
+    maxWidth = restWidth - style.firstLineIndent
+    lines = []
+    line = []
+    lineWidth = spaces = 0
+    words.reverse()
+    while words:
+        word = words.pop()
+        w = wordWidth(word, size)
+        space = textWidth(' ', line[-1][0], size) if line else 0
+        room = maxWidth - lineWidth - space
+        slack = (spaces + (space if single else 0))*shrink
+        if line and w > room + slack and w <= maxWidth:
+            lines.append((lineWidth, line))
+            (line, lineWidth, spaces, space) = ([], 0, 0, 0)
+            room = maxWidth = restWidth
+            slack = 0
+        if w > room + slack:
+            # Too long for any line, so fill this one a character at a time
+            (head, tail) = splitWord(word, room, size)
+            if not head and line:
+                lines.append((lineWidth, line))
+                (line, lineWidth, spaces, maxWidth) = ([], 0, 0, restWidth)
+                words.append(word)
+                continue
+            if not head:
+                (f, t) = word[0]
+                head = [(f, t[0])]
+                tail = ([(f, t[1:])] if t[1:] else []) + word[1:]
+            if tail:
+                words.append(tail)
+            word = head
+            w = wordWidth(word, size)
+        if line:
+            word = [(line[-1][0], ' ')] + word
+        for (f, t) in word:
+            if line and line[-1][0] == f:
+                line[-1] = (f, line[-1][1] + t)
+            else:
+                line.append((f, t))
+        lineWidth += space + w
+        spaces += space
+    if line:
+        lines.append((lineWidth, line))
+    return lines
+
+class ListingTable(Flowable):
+    def __init__(self, colWidths, aligns, header, rows, style, list_style,
+            hAlign='LEFT', layouts=None):
+        self.colWidths = colWidths
+        self.aligns = aligns
+        self.header = header
+        self.rows = rows
+        self.style = style
+        self.list_style = list_style
+        self.hAlign = hAlign
+        self.layouts = layouts
+
+    #########################################################################
+    # Lay out one string of a cell, as a list of (x, baseline, width,
+    # pieces, link span) lines or (x, top, height, Paragraph), and its
+    # height. The link span is how far below and above the baseline a
+    # link on the line reaches, which Paragraph makes depend on whether
+    # the text is one fragment.
+    #########################################################################
+    def layoutText(self, text, style, width, align, link, top):
+        runs = simpleRuns(text)
+        if runs is None:
+            if link:
+                text = '<a href="#{0}" color="blue">{1}</a>'.format(link, text)
+            if align == TA_RIGHT:
+                text = '<para alignment="right">{0}</para>'.format(text)
+            para = Paragraph(text, style)
+            height = para.wrap(width, 0x7fffffff)[1]
+            return ([(0, top, height, para)], height)
+
+        single = len([r for r in runs if r[2]]) < 2
+        if single:
+            span = (-style.fontSize/8.0, style.leading - style.fontSize/8.0)
+        else:
+            span = (-0.2*style.fontSize, style.fontSize)
+        items = []
+        x = style.leftIndent + style.firstLineIndent
+        baseline = top + style.fontSize
+        for (lineWidth, pieces) in breakLines(runs, style, width, single):
+            if align == TA_RIGHT:
+                x = width - style.rightIndent - lineWidth
+            items.append((x, baseline, lineWidth, pieces, span))
+            x = style.leftIndent
+            baseline += style.leading
+        return (items, baseline - style.fontSize - top)
+
+    def layoutRow(self, cells, link):
+        (padX, padY) = LISTING_PADDING
+        height = 0
+        layout = []
+        for (i, cell) in enumerate(cells):
+            width = self.colWidths[i] - 2*padX
+            cellLink = link if i == len(cells)-1 else None
+            items = []
+            top = 0
+            if isinstance(cell, list):
+                for text in cell:
+                    (lines, h) = self.layoutText(text, self.list_style, width,
+                            TA_LEFT, cellLink, top)
+                    items.extend(lines)
+                    top += h
+            else:
+                (items, top) = self.layoutText(cell, self.style, width,
+                        self.aligns[i], cellLink, 0)
+            layout.append(items)
+            height = max(height, top)
+        return (height + 2*padY, layout)
+
+    def wrap(self, availWidth, availHeight):
+        if self.layouts is None:
+            self.layouts = (self.layoutRow(self.header, None),
+                [self.layoutRow(row.cells, row.link) for row in self.rows])
+        (header, rows) = self.layouts
+        self.width = sum(self.colWidths)
+        self.height = header[0] + sum(r[0] for r in rows)
+        return (self.width, self.height)
+
+    def split(self, availWidth, availHeight):
+        self.wrap(availWidth, availHeight)
+        (header, rows) = self.layouts
+        height = header[0]
+        n = 0
+        for (h, cells) in rows:
+            if height + h > availHeight:
+                break
+            height += h
+            n += 1
+        if n == 0:
+            return []
+        if n == len(rows):
+            return [self]
+        return [
+            ListingTable(self.colWidths, self.aligns, self.header,
+                self.rows[:n], self.style, self.list_style, self.hAlign,
+                (header, rows[:n])),
+            ListingTable(self.colWidths, self.aligns, self.header,
+                self.rows[n:], self.style, self.list_style, self.hAlign,
+                (header, rows[n:]))]
+
+    def draw(self):
+        canvas = self.canv
+        (padX, padY) = LISTING_PADDING
+        (header, rows) = self.layouts
+        size = self.style.fontSize
+        leading = self.style.leading
+        text = canvas.beginText()
+        text.setFillColor(self.style.textColor)
+        font = None
+        lines = []
+        top = self.height
+        for (row, (height, layout)) in zip([None] + self.rows,
+                [header] + rows):
+            lines.append((0, top, self.width, top))
+            x = padX
+            for (i, items) in enumerate(layout):
+                link = row and row.link if i == len(layout)-1 else None
+                if row and row.anchor and i == 0:
+                    ax = items[0][0] if items else 0
+                    canvas.bookmarkHorizontal(row.anchor, x + ax,
+                            top - padY - size + leading)
+                if link:
+                    text.setFillColor(blue)
+                for item in items:
+                    if isinstance(item[3], Paragraph):
+                        # Keep the text in reading order around it
+                        canvas.drawText(text)
+                        item[3].drawOn(canvas, x + item[0],
+                                top - padY - item[1] - item[2])
+                        text = canvas.beginText()
+                        text.setFillColor(blue if link else
+                                self.style.textColor)
+                        font = None
+                        continue
+                    (ix, baseline, width, pieces, span) = item
+                    y = top - padY - baseline
+                    text.setTextOrigin(x + ix, y)
+                    for (f, t) in pieces:
+                        if f != font:
+                            text.setFont(f, size)
+                            font = f
+                        text.textOut(t)
+                    if link:
+                        canvas.linkRect('', link,
+                            (x + ix, y + span[0], x + ix + width, y + span[1]),
+                            relative=1)
+                if link:
+                    text.setFillColor(self.style.textColor)
+                x += self.colWidths[i]
+            top -= height
+        canvas.drawText(text)
+
+        canvas.setStrokeColor(lightgrey)
+        canvas.setLineWidth(1)
+        canvas.lines(lines)
+
+##############################################################################
+# CRFPlan - Everything drawing a plate's CRF page needs that does not
+# depend on the record: the background and page extents, every box to
+# blank, and for each field with boxes its geometry, whether it is hidden
+# and how its value is drawn. A CRFPlanTable makes one plan per plate and
+# visit and DFcrf only fills in the values.
+##############################################################################
+FieldPlan = namedtuple('FieldPlan', '''field, bb, boxes, hidden, strategy,
+    format_decimal''')
+
+def drawStrategy(field):
+    '''How DFcrf.drawField draws a field's value'''
+    if (field.type == 'Choice' and len(field.rects) > 1) or \
+            field.type == 'Check':
+        return 'check'
+    if field.type == 'Date' and len(field.rects) > 1:
+        return 'date'
+    if field.type == 'Number' and len(field.rects) == 2 and \
+            field.format == 'nn:nn':
+        return 'time'
+    if field.type == 'Number' and len(field.rects) > 1:
+        return 'number'
+    if field.type != 'Choice':
+        return 'text'
+    return 'choice'
+
+class CRFPlan(object):
+    def __init__(self, plate, background, hide_blinded, redaction_dict):
+        self.background = background
+        if background is None:
+            i_w, i_h = (1728, 2200)
+        else:
+            (path, i_w, i_h) = background
+        self.image_size = (i_w, i_h)
+
+        # Find field bounding box if bigger than background
+        p_w = i_w
+        p_h = i_h
+        self.blanks = []
+        self.fields = []
+        for field in plate.fieldList():
+            boxes = tuple([(r.left, r.top, r.width, r.height)
+                for r in field.rects or []])
+            self.blanks.extend(boxes)
+            bb = field.boundingBox()
+            if bb is None:
+                continue
+            if bb[2]*2+5 > p_w:
+                p_w = bb[2]*2+5
+            if bb[3]*2+5 > p_h:
+                p_h = bb[3]*2+5
+
+            hidden = bool((redaction_dict and \
+                    redaction_dict.get((plate.number(), field.number))) or \
+                    (hide_blinded and field.isBlinded()))
+            strategy = drawStrategy(field)
+            format_decimal = None
+            if strategy in ('time', 'number'):
+                try:
+                    format_decimal = field.format.index('.')
+                except ValueError:
+                    format_decimal = len(field.format)
+            self.fields.append(FieldPlan(field, bb, boxes, hidden, strategy,
+                format_decimal))
+        self.extents = (p_w, p_h)
+
+class CRFPlanTable(object):
+    def __init__(self, study, backgrounds, hide_blinded, redaction_dict):
+        self.study = study
+        self.backgrounds = backgrounds
+        self.hide_blinded = hide_blinded
+        self.redaction_dict = redaction_dict
+        self.plans = {}
+
+    def plan(self, plate_num, visit_num):
+        '''Returns the CRFPlan for a plate at a visit, or None if the study
+        has no such plate'''
+        key = (plate_num, visit_num)
+        if key not in self.plans:
+            plate = self.study.plate(plate_num)
+            if plate is None:
+                self.plans[key] = None
+            else:
+                self.plans[key] = CRFPlan(plate,
+                        self.backgrounds.lookup(plate_num, visit_num),
+                        self.hide_blinded, self.redaction_dict)
+        return self.plans[key]
+
 ##############################################################################
 # DFimage - DataFax Image Representation
 ##############################################################################
 class DFimage(Flowable):
-    def __init__(self, size, path, label):
+    def __init__(self, size, path, label, image_size, images):
         if size is None:
             size = (6.3*inch, 8.2*inch)
         self.size = size
         self.path = path
         self.label = label
+        self.image_size = image_size
+        self.images = images
 
     def wrap(self, *args):
         return self.size
@@ -204,16 +617,11 @@ class DFimage(Flowable):
         canvas.setFont('Helvetica', 8)
         canvas.drawCentredString(where[2]/2, 0*inch, self.label)
 
-        try:
-            img = Image.open(self.path)
-        except IOError:
+        if self.image_size is None:
             print('image {0} unsupported format'.format(self.path))
             return
 
-        if img is None:
-            i_w, i_h = (864, 1100)
-        else:
-            i_w, i_h = img.size
+        i_w, i_h = self.image_size
 
         # Calculate scaling and translation for background image
         window_width = where[2]
@@ -230,12 +638,12 @@ class DFimage(Flowable):
         canvas.translate(where[0]+translate_x, where[1]+translate_y)
         canvas.scale(scale, scale)
 
-        # If we have a background image, draw it now
-        if img:
-            try:
-                canvas.drawImage(self.path, 0, 0)
-            except IOError:
-                print('unable to draw', self.path)
+        # Draw the image
+        try:
+            canvas.drawImage(self.images.get(self.path, self.image_size),
+                    0, 0, i_w, i_h)
+        except IOError:
+            print('unable to draw', self.path)
 
         canvas.setStrokeColor(black)
 
@@ -289,12 +697,241 @@ class DFXObj(Flowable):
         # Draw image bounding box
         canvas.rect(0, 0, i_w, i_h)
 
+##############################################################################
+# AttachmentCache - Attached PDF pages and image sizes, parsed once per run.
+# Entries are keyed by path, modification time and size, so a file that
+# changes is parsed again. The least recently used entries are dropped
+# once the files they came from add up to more than max_bytes.
+#
+# Reusing the same page XObjects lets pdfrw embed a page once per
+# document, however many records it is attached to. pdfrw remembers what
+# it made for each document on the pages themselves, so that is made a
+# weak reference here, or the cache would keep every finished document.
+##############################################################################
+ATTACHMENT_CACHE_BYTES = 64*1024*1024
+
+class AttachmentCache(object):
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.bytes = 0
+
+    def lookup(self, path):
+        '''Returns ('pdf', pages) or ('image', (width, height)). pages is
+        None for a PDF pdfrw cannot convert and the size is None for an
+        image PIL cannot read.'''
+        st = os.stat(path)
+        key = (path, st.st_mtime, st.st_size)
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            entry = self.load(path)
+            self.bytes += st.st_size
+        self.entries[key] = entry
+
+        while self.bytes > self.max_bytes and len(self.entries) > 1:
+            (_, _, size), _ = self.entries.popitem(last=False)
+            self.bytes -= size
+        return entry
+
+    def load(self, path):
+        with open(path, 'rb') as f:
+            is_pdf = f.read(4) == str('%PDF')
+
+        if is_pdf:
+            pages = PdfReader(path).pages
+            try:
+                pages = [pagexobj(x) for x in pages]
+                seen = set()
+                for page in pages:
+                    weakDerived(page, seen)
+            except:
+                pages = None
+            return ('pdf', pages)
+
+        try:
+            with open(path, 'rb') as f:
+                size = Image.open(f).size
+        except IOError:
+            size = None
+        return ('image', size)
+
+def weakDerived(obj, seen):
+    '''Give obj and everything it refers to a weak derived_rl_obj table'''
+    if id(obj) in seen:
+        return
+    if isinstance(obj, PdfDict):
+        seen.add(id(obj))
+        obj.private.derived_rl_obj = weakref.WeakKeyDictionary()
+        for value in obj.itervalues():
+            weakDerived(value, seen)
+    elif isinstance(obj, PdfArray):
+        seen.add(id(obj))
+        obj.derived_rl_obj = weakref.WeakKeyDictionary()
+        for value in obj:
+            weakDerived(value, seen)
+
+##############################################################################
+# ImageProcessor - Downsample and recompress attached images and CRF
+# backgrounds before they go in the PDF. Images are converted in a thread
+# pool as records are output, ahead of layout, and written to a cache
+# directory under a hash of their contents and the settings, so a file
+# is only converted once however many runs use it.
+#
+# An image is scaled to dpi at the largest size it can be drawn, the
+# frame of an attached image page. It keeps the size it is drawn at, so
+# only the resolution changes. Without a dpi, grayscale or format the
+# images are used as they are.
+##############################################################################
+IMAGE_THREADS = 4
+IMAGE_FRAME = (6.3*inch, 8.2*inch)
+
+class ImageProcessor(object):
+    def __init__(self, dpi, image_format, quality, grayscale, cache_dir):
+        self.dpi = dpi
+        self.image_format = image_format
+        self.quality = quality
+        self.grayscale = grayscale
+        self.cache_dir = cache_dir
+        self.enabled = bool(dpi or image_format or grayscale)
+        self.settings = 'dpi={0},format={1},quality={2},grayscale={3}'.format(
+                dpi, image_format or 'flate', quality, int(grayscale))
+        self.pid = None
+        self.pool = None
+        self.converted = {}
+
+    def submit(self, path, size):
+        '''Start converting the image at path, of size (width, height)'''
+        if not self.enabled:
+            return
+        # Threads do not survive a fork, so each --jobs worker has its own
+        if self.pid != os.getpid():
+            self.pid = os.getpid()
+            self.pool = ThreadPool(IMAGE_THREADS)
+            self.converted = {}
+        if path not in self.converted:
+            self.converted[path] = self.pool.apply_async(self.convert,
+                    (path, size))
+
+    def get(self, path, size):
+        '''Returns the path of the converted image to draw'''
+        if not self.enabled:
+            return path
+        self.submit(path, size)
+        return self.converted[path].get()
+
+    def convert(self, path, size):
+        try:
+            with open(path, 'rb') as f:
+                digest = hashlib.sha1(f.read())
+        except IOError:
+            return path
+        digest.update(self.settings)
+        if self.image_format == 'jpeg':
+            ext = '.jpg'
+        else:
+            ext = '.png'
+        out = os.path.join(self.cache_dir, digest.hexdigest() + ext)
+        if os.path.exists(out):
+            return out
+
+        try:
+            img = Image.open(path)
+            img.load()
+        except IOError:
+            return path
+
+        # Leave images with transparency alone
+        if img.mode in ('RGBA', 'LA') or 'transparency' in img.info:
+            return path
+        mode = img.mode
+        if self.grayscale or img.mode in ('1', 'L', 'I', 'F'):
+            img = img.convert('L')
+        else:
+            img = img.convert('RGB')
+        changed = img.mode != mode or self.image_format == 'jpeg'
+
+        if self.dpi:
+            scale = min(IMAGE_FRAME[0]/size[0], IMAGE_FRAME[1]/size[1])
+            w = int(size[0]*scale*self.dpi/72 + 0.5)
+            h = int(size[1]*scale*self.dpi/72 + 0.5)
+            if w < img.size[0] and h < img.size[1]:
+                img = img.resize((w, h), Image.ANTIALIAS)
+                changed = True
+
+        # ReportLab compresses an unchanged gray or colour image the same
+        # way itself
+        if not changed:
+            return path
+
+        # Other runs or --jobs workers may be writing the same image
+        fd, tmp = tempfile.mkstemp(ext, dir=self.cache_dir)
+        with os.fdopen(fd, 'wb') as f:
+            if self.image_format == 'jpeg':
+                img.save(f, 'JPEG', quality=self.quality)
+            else:
+                # It is decoded and compressed again by ReportLab
+                img.save(f, 'PNG', compress_level=1)
+        os.rename(tmp, out)
+        return out
+
+##############################################################################
+# BackgroundTable - The study's CRF background images, listed and sized
+# once per run, so each CRF page finds its background with a lookup
+##############################################################################
+class BackgroundTable(object):
+    def __init__(self, studydir, prefer_background):
+        self.preferred = []
+        if prefer_background:
+            self.preferred = prefer_background.split(',')
+        self.images = {}
+        self.resolved = {}
+
+        bkgd_dir = os.path.join(studydir, 'bkgd')
+        try:
+            names = os.listdir(bkgd_dir)
+        except OSError:
+            names = []
+        for name in names:
+            if not name.endswith('.png'):
+                continue
+            path = os.path.join(bkgd_dir, name)
+            try:
+                with open(path, 'rb') as f:
+                    size = Image.open(f).size
+            except IOError:
+                continue
+            self.images[name] = (path, size[0], size[1])
+
+    def lookup(self, plate_num, visit_num):
+        '''Returns the (path, width, height) of the background for a plate at
+        a visit, or None if there is none'''
+        key = (plate_num, visit_num)
+        if key in self.resolved:
+            return self.resolved[key]
+
+        names = []
+        # If we have a prefered background, try that first
+        for bkgd in self.preferred:
+            names.append('DFbkgd%03d_%d_%s.png' % (plate_num, visit_num, bkgd))
+            names.append('DFbkgd%03d_all_%s.png' % (plate_num, bkgd))
+
+        # Regular background names
+        names.append('DFbkgd%03d_%d.png' % (plate_num, visit_num))
+        names.append('DFbkgd%03d.png' % plate_num)
+
+        background = None
+        for name in names:
+            if name in self.images:
+                background = self.images[name]
+                break
+        self.resolved[key] = background
+        return background
+
 ##############################################################################
 # DFcrf - DataFax CRF Representation
 ##############################################################################
 class DFcrf(Flowable):
-    def __init__(self, size, study, datarec, hide_blinded, redaction_dict,
-            prefer_background, header_callback):
+    def __init__(self, size, study, datarec, plans, images, header_callback):
         if size is None:
             size = (6.3*inch, 8.2*inch)
         self.size = size
@@ -302,57 +939,18 @@ class DFcrf(Flowable):
         self.datarec = datarec
         self.font = 'Helvetica'
         self.font_size = 20
-        self.hide_blinded = hide_blinded
-        self.redaction_dict = redaction_dict
-        self.prefer_background = prefer_background
+        self.plans = plans
+        self.images = images
         self.header_callback = header_callback
 
     def wrap(self, *args):
         return self.size
 
-    def drawBackground(self, where, visit_num, plate):
+    def drawBackground(self, where, plan):
         canvas = self.canv
-        plate_num = plate.number()
-        img = None
-        path = None
-        bkgds = []
-        # If we have a prefered background, try that first
-        if self.prefer_background:
-            for bkgd in self.prefer_background.split(','):
-                bkgds.append('bkgd/DFbkgd%03d_%d_%s.png' % \
-                    (plate_num, visit_num, bkgd))
-                bkgds.append('bkgd/DFbkgd%03d_all_%s.png' % \
-                    (plate_num, bkgd))
-
-        # Regular background names
-        bkgds.append('bkgd/DFbkgd%03d_%d.png' % (plate_num, visit_num))
-        bkgds.append('bkgd/DFbkgd%03d.png' % plate_num)
-
-        # Look for correct background image
-        for bkgd in bkgds:
-            path = os.path.join(self.study.studydir, bkgd)
-            try:
-                img = Image.open(path)
-            except IOError:
-                continue
-
-            break
-
-        if img is None:
-            i_w, i_h = (1728, 2200)
-        else:
-            i_w, i_h = img.size
-
-        # Find field bounding box if biggen than background
-        p_w = i_w
-        p_h = i_h
-        for field in plate.fieldList():
-            bb = field.boundingBox()
-            if bb:
-                if bb[2]*2+5 > p_w:
-                    p_w = bb[2]*2+5
-                if bb[3]*2+5 > p_h:
-                    p_h = bb[3]*2+5
+        background = plan.background
+        (i_w, i_h) = plan.image_size
+        (p_w, p_h) = plan.extents
 
         # Calculate scaling and translation for background image
         window_width = where[2]
@@ -369,9 +967,20 @@ class DFcrf(Flowable):
         canvas.translate(where[0]+translate_x, where[1]+translate_y)
         canvas.scale(scale, scale)
 
-        # If we have a background image, draw it now
-        if img:
-            canvas.drawImage(path, 0, p_h-i_h)
+        # If we have a background image, draw it now. It is put in the
+        # document once, as a form that every page using it refers to.
+        if background:
+            path = background[0]
+            form = 'bkgd_' + os.path.splitext(os.path.basename(path))[0]
+            if not canvas.hasForm(form):
+                canvas.beginForm(form, 0, 0, i_w, i_h)
+                canvas.drawImage(self.images.get(path, (i_w, i_h)),
+                        0, 0, i_w, i_h)
+                canvas.endForm()
+            canvas.saveState()
+            canvas.translate(0, p_h-i_h)
+            canvas.doForm(form)
+            canvas.restoreState()
 
         canvas.setStrokeColor(black)
 
@@ -387,39 +996,43 @@ class DFcrf(Flowable):
 
         canvas.setFont(self.font, self.font_size)
 
-    def drawBoxes(self, field, stroke, fill):
+    def drawBoxes(self, fplan, stroke, fill):
         '''Draw and fill boxes in specified colors'''
         canvas = self.canv
         canvas.setStrokeColor(stroke)
         canvas.setFillColor(fill)
-        for r in field.rects or []:
-            canvas.rect(r.left, -r.top, r.width, -r.height, fill=1)
+        for (left, top, width, height) in fplan.boxes:
+            canvas.rect(left, -top, width, -height, fill=1)
 
-    def blankFieldBackground(self, field):
+    def blankFieldBackgrounds(self, plan):
         '''Blank boxes slightly larger than actual size to overwrite
         printed boxes on CRF form.'''
         canvas = self.canv
         canvas.setFillColor(white)
         canvas.setStrokeColor(white)
-        for r in field.rects or []:
-            canvas.rect(r.left-2, -r.top+2, r.width+4, -(r.height+4), fill=1)
+        for (left, top, width, height) in plan.blanks:
+            canvas.rect(left-2, -top+2, width+4, -(height+4), fill=1)
 
-    def drawMissingField(self, field):
-        self.drawBoxes(field, blue, orange)
+    def drawMissingField(self, fplan):
+        self.drawBoxes(fplan, blue, orange)
 
-    def drawField(self, field, value, decoded_value, box):
+    def drawField(self, fplan, value, decoded_value, box):
         canvas = self.canv
+        field = fplan.field
+        strategy = fplan.strategy
 
         # Draw outline of box
-        self.drawBoxes(field, blue, white)
+        self.drawBoxes(fplan, blue, white)
 
         # Fill in Data
         canvas.setFillColor(blue)
 
+        # A time goes in two number boxes either side of the colon
+        if strategy == 'time' and not (':' in value or value == ''):
+            strategy = 'number'
+
         # Choice multiple boxes, or check
-        if (field.type == "Choice" and \
-            len(field.rects) > 1) or \
-            field.type == "Check":
+        if strategy == 'check':
             if box is not None:
                 r = field.rects[box]
                 canvas.saveState()
@@ -433,7 +1046,7 @@ class DFcrf(Flowable):
                 canvas.drawPath(path)
                 canvas.restoreState()
         # Date
-        elif field.type == 'Date' and len(field.rects) > 1:
+        elif strategy == 'date':
             clean_value = re.sub('[^0-9A-Za-z]','', value)
             i = 0
             for r in field.rects:
@@ -441,8 +1054,7 @@ class DFcrf(Flowable):
                     canvas.drawCentredString(r.left+(r.width/2),
                         -(r.top+(4*r.height/5)), clean_value[i])
                 i += 1
-        elif field.type == 'Number' and len(field.rects) == 2 and \
-                field.format == 'nn:nn' and (':' in value or value == ''):
+        elif strategy == 'time':
             if value == '':
                 value = '  :  ';
             clean_value = value.split(':')
@@ -452,11 +1064,8 @@ class DFcrf(Flowable):
                     canvas.drawCentredString(r.left+(r.width/2),
                         -(r.top+(4*r.height/5)), clean_value[i])
                 i += 1
-        elif field.type == 'Number' and len(field.rects) > 1:
-            try:
-                format_decimal = field.format.index('.')
-            except ValueError:
-                format_decimal = len(field.format)
+        elif strategy == 'number':
+            format_decimal = fplan.format_decimal
 
             try:
                 value_decimal = value.index('.')
@@ -491,7 +1100,7 @@ class DFcrf(Flowable):
                 i += 1
 
         # Other values shorter than number of boxes
-        elif field.type != 'Choice' and len(value) <= len(field.rects):
+        elif strategy == 'text' and len(value) <= len(field.rects):
             i = 0
             for r in field.rects:
                 if i < len(value):
@@ -554,21 +1163,18 @@ class DFcrf(Flowable):
             bookmark = '{0}_{1}_{2}B{3}'.format(pid_num, visit_num, plate_num, i)
             canvas.bookmarkHorizontal(bookmark, -12, self.size[1]+inch)
 
-        plate = self.study.plate(plate_num)
-        if plate is None:
+        plan = self.plans.plan(plate_num, visit_num)
+        if plan is None:
             print('Plate ', plate_num, ' does not exist in study.')
             return
 
         canvas.saveState()
-        self.drawBackground(where, visit_num, plate)
+        self.drawBackground(where, plan)
+        self.blankFieldBackgrounds(plan)
 
-        for field in plate.fieldList():
-            self.blankFieldBackground(field)
-
-        for field in plate.fieldList():
-            bb = field.boundingBox()
-            if bb is None:
-                continue
+        for fplan in plan.fields:
+            field = fplan.field
+            bb = fplan.bb
 
             # skip bookmarks on lost records
             if not is_lost and not is_deleted:
@@ -583,20 +1189,18 @@ class DFcrf(Flowable):
                 value = field_values[field.number-1]
 
             # If we're blinded to internal fields, don't display them
-            if (self.redaction_dict and \
-                    self.redaction_dict.get((plate_num, field.number))) or \
-                    (self.hide_blinded and field.isBlinded()):
-                self.drawBoxes(field, black, black)
+            if fplan.hidden:
+                self.drawBoxes(fplan, black, black)
             else:
                 if is_lost or is_deleted:
-                    self.drawBoxes(field, dimgrey, white)
+                    self.drawBoxes(fplan, dimgrey, white)
                 else:
                     missingLabel = self.study.missingValueLabel(value)
                     if missingLabel is not None:
-                        self.drawMissingField(field)
+                        self.drawMissingField(fplan)
                     else:
                         (box, decoded_value) = field.decode(value)
-                        self.drawField(field, value, decoded_value, box)
+                        self.drawField(fplan, value, decoded_value, box)
 
         canvas.restoreState()
         if is_lost or is_deleted:
@@ -617,43 +1221,53 @@ class DFcrf(Flowable):
 ##############################################################################
 class DFpdf(object):
 
-    lost_codes = {
-            '1': 'Patient Missed Visit',
-            '2': 'Exam or Test Not Performed',
-            '3': 'Data Not Available',
-            '4': 'Patient Refused',
-            '5': 'Patient Moved Away',
-            '6': 'Patient Lost to Follow-up',
-            '7': 'Patient Died',
-            '8': 'Patient Terminated due to Study Illness',
-            '9': 'Patient Terminated due to Other Illness',
-            '10': 'Other Reason'
-    }
+    lost_codes = audittrail.LOST_CODES
 
     def __init__(self, path, name, sql, study, hide_internal, redaction_dict, \
-            include_attached_images, prefer_background, shadow_pages, \
+            include_attached_images, plans, attachments, images, \
+            shadow_pages, \
             format_pid, \
             include_chronological_audit, \
-            include_field_audit, fontsize, leading, include_secondaries):
+            include_field_audit, fontsize, leading, include_secondaries, \
+            audit_txn, volume_pages, volume_bytes):
         self.path = path
         self.name = name
         self.study = study
         self.hide_internal = hide_internal
         self.redaction_dict = redaction_dict
         self.include_attached_images = include_attached_images
-        self.prefer_background = prefer_background
+        self.plans = plans
+        self.attachments = attachments
+        self.images = images
         self.shadow_pages = shadow_pages
         self.include_chronological_audit = include_chronological_audit
         self.include_field_audit = include_field_audit
         self.include_secondaries = include_secondaries
+        self.audit_txn = audit_txn
+        self.audit_trail = audittrail.AuditTrail(study)
+        self.audit_pid = None
+        self.audit_rows = {}
+        self.secondaries_pid = None
+        self.secondaries = {}
         self.sql = sql
-        self.doc = BaseDocTemplate(os.path.join(path, name)+'.pdf', showBoundary=1, pagesize=letter)
-        template = PageTemplate('normal', [Frame(inch, inch, 6.5*inch, 8.4*inch)], onPageEnd=self.pageHeader)
-        self.doc.addPageTemplates(template)
         self.styles = stylesheet(fontsize, leading)
         self.outlines = []
-        #self.content = [TableOfContents(), PageBreak(), DFOutlines(self.outlines)]
-        self.content = [DFOutlines(self.outlines)]
+
+        # With a page or byte cap, the patient is written in volumes as
+        # records are output, so only one volume is held in memory
+        self.volume_pages = volume_pages
+        self.volume_bytes = volume_bytes
+        self.streaming = bool(volume_pages or volume_bytes)
+        self.volume = 0
+        self.volumeRecords = []
+        self.volumeBytes = 0
+        if self.streaming:
+            self.doc = None
+            self.content = []
+        else:
+            self.doc = self.newDocument(os.path.join(path, name)+'.pdf')
+            #self.content = [TableOfContents(), PageBreak(), DFOutlines(self.outlines)]
+            self.content = [DFOutlines(self.outlines)]
         self.jobsize = 1
         self.headerId = 0
         self.headerVisitNum = 0
@@ -662,14 +1276,69 @@ class DFpdf(object):
         self.headerPlateLabel = ''
         self.format_pid = format_pid
 
+    def newDocument(self, filename):
+        doc = BaseDocTemplate(filename, showBoundary=1, pagesize=letter)
+        template = PageTemplate('normal', [Frame(inch, inch, 6.5*inch, 8.4*inch)], onPageEnd=self.pageHeader)
+        doc.addPageTemplates(template)
+        doc.title = 'Closeout PDF {0}'.format(self.name)
+        doc.author = getpass.getuser()
+        doc.subject = 'Closeout PDF {0}'.format(self.name)
+        return doc
+
+    def files(self):
+        '''Returns the paths of the PDF files written'''
+        base = os.path.join(self.path, self.name)
+        if not self.streaming:
+            return [base + '.pdf']
+        return ['{0}_{1:03d}.pdf'.format(base, volume)
+                for volume in range(1, self.volume+1)]
+
     def close(self, quiet):
+        if self.streaming:
+            if self.doc is not None:
+                self.endVolume()
+            return
         if not quiet:
             self.doc.setProgressCallBack(self.progressCB)
-        self.doc.title = 'Closeout PDF {0}'.format(self.name)
-        self.doc.author = getpass.getuser()
-        self.doc.subject = 'Closeout PDF {0}'.format(self.name)
         self.doc.build(self.content)
 
+    #########################################################################
+    # Volumes - In streaming mode the patient is written to NAME_001.pdf,
+    # NAME_002.pdf, ... A volume is closed after the record that takes it
+    # to the page or byte cap, so records are never split across volumes,
+    # and each volume has the bookmarks of its own records.
+    #########################################################################
+    def startVolume(self):
+        self.volume += 1
+        self.doc = self.newDocument('{0}_{1:03d}.pdf'.format(
+            os.path.join(self.path, self.name), self.volume))
+        self.doc._startBuild()
+        self.volumeRecords = []
+        self.volumeBytes = 0
+
+    def writeContent(self):
+        '''Lay out the flowables output so far, releasing them'''
+        doc = self.doc
+        doc.canv._doctemplate = doc
+        try:
+            while self.content:
+                doc.clean_hanging()
+                doc.handle_flowable(self.content)
+        finally:
+            del doc.canv._doctemplate
+
+    def endVolume(self):
+        canvas = self.doc.canv
+        outlines = self.patientOutlines(self.volumeRecords)
+        if outlines:
+            outlines[0][0] = '{0} (Volume {1})'.format(outlines[0][0],
+                    self.volume)
+        for o in outlines:
+            canvas.addOutlineEntry(o[0], o[1], o[2], o[3])
+        canvas.showOutline()
+        self.doc._endBuild()
+        self.doc = None
+
     def setPageHeader(self, pid_num, visit_num, plate_num):
         self.headerId = pid_num
         self.headerVisitNum = visit_num
@@ -678,6 +1347,10 @@ class DFpdf(object):
         self.headerPlateLabel = self.study.pageLabel(visit_num, plate_num)
 
     def pageHeader(self, canvas, doc):
+        # Count what the page adds to the volume
+        if self.streaming:
+            self.volumeBytes += sum([len(c) for c in canvas._code])
+
         if not self.headerId:
             return
 
@@ -759,6 +1432,12 @@ class DFpdf(object):
     # Output Outlines (Bookmarks)
     #########################################################################
     def generateBookmarksForPatient(self, records):
+        # Volumes get the bookmarks of their own records as they are closed
+        if not self.streaming:
+            self.outlines.extend(self.patientOutlines(records))
+
+    def patientOutlines(self, records):
+        outlines = []
         domains = {}
         domainmap = self.study.domainMap()
         lastID = None
@@ -773,17 +1452,17 @@ class DFpdf(object):
             if lastID is None:
                 lastVisit = None
                 lastID = pid_num
-                self.outlines.append([formatPID(self.format_pid, pid_num), bookmark+'B0', 0, True])
-                self.outlines.append(['By Visit', bookmark+'B1', 1, True])
+                outlines.append([formatPID(self.format_pid, pid_num), bookmark+'B0', 0, True])
+                outlines.append(['By Visit', bookmark+'B1', 1, True])
             if lastVisit != visit_num:
                 lastVisit = visit_num
-                self.outlines.append([visit_label, bookmark+'B2', 2, True])
-            self.outlines.append([page_label, bookmark+'B3', 3, True])
-            self.outlines.append(['Data Fields', bookmark+'_DA', 4, True])
+                outlines.append([visit_label, bookmark+'B2', 2, True])
+            outlines.append([page_label, bookmark+'B3', 3, True])
+            outlines.append(['Data Fields', bookmark+'_DA', 4, True])
             if self.include_chronological_audit:
-                self.outlines.append(['Audit by Time', bookmark+'_AU', 4, True])
+                outlines.append(['Audit by Time', bookmark+'_AU', 4, True])
             if self.include_field_audit:
-                self.outlines.append(['Audit by Field', bookmark+'_FA', 4, True])
+                outlines.append(['Audit by Field', bookmark+'_FA', 4, True])
 
             domain = domainmap.label(plate_num)
             if domain not in domains:
@@ -800,21 +1479,22 @@ class DFpdf(object):
             for (pid_num, visit_num, plate_num, page_label, visit_label) in items:
                 bookmark = '{0}_{1}_{2}'.format(pid_num, visit_num, plate_num)
                 if lastDomain is None:
-                    self.outlines.append(['By Domain', bookmark+'B4', 1, True])
+                    outlines.append(['By Domain', bookmark+'B4', 1, True])
                 if lastDomain != domain:
-                    self.outlines.append([domain, bookmark+'B5', 2, True])
+                    outlines.append([domain, bookmark+'B5', 2, True])
                     lastDomain = domain
                     lastPlate = None
                 if lastVisit != visit_num:
-                    self.outlines.append([visit_label, bookmark+'B6', 3, True])
+                    outlines.append([visit_label, bookmark+'B6', 3, True])
                     lastVisit = visit_num
-                self.outlines.append([page_label, bookmark+'B7', 4, True])
-                self.outlines.append(['Data Fields', bookmark+'_DA', 5, True])
+                outlines.append([page_label, bookmark+'B7', 4, True])
+                outlines.append(['Data Fields', bookmark+'_DA', 5, True])
                 if self.include_chronological_audit:
-                    self.outlines.append(['Audit by Time', bookmark+'_AU', 5, True])
+                    outlines.append(['Audit by Time', bookmark+'_AU', 5, True])
                 if self.include_field_audit:
-                    self.outlines.append(['Audit by Field', bookmark+'_FA', 5, True])
+                    outlines.append(['Audit by Field', bookmark+'_FA', 5, True])
 
+        return outlines
 
     #########################################################################
     # Output Field Audit
@@ -827,6 +1507,14 @@ class DFpdf(object):
         plate = self.study.plate(plate_num)
         bookmark = '{0}_{1}_{2}_FA'.format(pid_num, visit_num, plate_num)
         title = Paragraph('<a name="{0}"/>Audit by Field'.format(bookmark), styleH)
+
+        # Group the operations by field once, keeping their order. Those
+        # with funiqueid 0 apply to every field.
+        fieldOps = {}
+        for (i, rec) in enumerate(auditOps):
+            fieldOps.setdefault(rec.funiqueid, []).append((i, rec))
+        allFieldOps = fieldOps.get(0, [])
+
         for field in plate.fieldList():
             if (self.redaction_dict and \
                     self.redaction_dict.get((plate_num, field.number))) or \
@@ -837,32 +1525,26 @@ class DFpdf(object):
 
             if field.boundingBox() is None:
                 continue
-            auditList = [[
-                Paragraph('<b>Date</b>', styleN),
-                Paragraph('<b>Time</b>', styleN),
-                Paragraph('<b>User</b>', styleN),
-                Paragraph('<b>Operation</b>', styleN)]]
-            for rec in auditOps:
-                if field.id() != rec.funiqueid and rec.funiqueid != 0:
-                    continue
-                changes = []
-                for o in rec.ops:
-                    changes.append(Paragraph(o, styleI))
-                auditList.append([
-                    Paragraph('{0}'.format(rec.tdate), styleN),
-                    Paragraph('{0}'.format(rec.ttime), styleN),
-                    Paragraph(rec.who, styleN),
-                    changes])
-
-            table = Table(auditList, colWidths=[
+            auditList = []
+            ops = fieldOps.get(field.id(), [])
+            if allFieldOps and field.id() != 0:
+                ops = merge(ops, allFieldOps)
+            for (i, rec) in ops:
+                auditList.append(ListingRow([
+                    '{0}'.format(rec.tdate),
+                    '{0}'.format(rec.ttime),
+                    rec.who,
+                    list(rec.ops)], None, None))
+
+            table = ListingTable([
                 0.14*width,
                 0.12*width,
                 0.15*width,
-                0.58*width], splitByRow=1, repeatRows=1, hAlign='RIGHT')
-            tablestyle = TableStyle([
-                ('VALIGN', (0,0), (-1, -1), 'TOP'),
-                ('LINEABOVE', (0,0), (-1, -1), 1, lightgrey)])
-            table.setStyle(tablestyle)
+                0.58*width], (TA_LEFT, TA_LEFT, TA_LEFT, TA_LEFT), [
+                '<b>Date</b>',
+                '<b>Time</b>',
+                '<b>User</b>',
+                '<b>Operation</b>'], auditList, styleN, styleI, hAlign='RIGHT')
             bookmark = '{0}_{1}_{2}_{3}_audit'.format(pid_num, visit_num, plate_num, field.number)
             if title:
                 self.content.append(KeepTogether([title, Paragraph('<para><a name="{0}"/>{1}. {2}</para>'.format(bookmark, field.number, description), styleA), table]))
@@ -883,20 +1565,21 @@ class DFpdf(object):
         styleI = self.styles['indented']
         bookmark = '{0}_{1}_{2}_AU'.format(pid_num, visit_num, plate_num)
         title = Paragraph('<a name="{0}"/>Chronological Audit'.format(bookmark), styleH)
+        header = [
+            '<b>Field</b>',
+            '<b>Description</b>',
+            '<b>Operation</b>']
         last = None
         auditList = []
         for rec in auditRecs:
             if last is None or last.who != rec.who or last.tdate != rec.tdate \
                     or last.ttime != rec.ttime:
                 if auditList:
-                    table = Table(auditList, colWidths=[
+                    table = ListingTable([
                         0.1*width,
                         0.3*width,
-                        0.6*width], splitByRow=1, repeatRows=1, hAlign='LEFT')
-                    tablestyle = TableStyle([
-                        ('VALIGN', (0,0), (-1, -1), 'TOP'),
-                        ('LINEABOVE', (0,0), (-1, -1), 1, lightgrey)])
-                    table.setStyle(tablestyle)
+                        0.6*width], (TA_RIGHT, TA_LEFT, TA_LEFT), header,
+                        auditList, styleN, styleI)
                     if title:
                         self.content.append(KeepTogether([ title, \
                         Paragraph('{0} {1} {2}'.format(last.tdate, last.ttime, last.who), styleA), table]))
@@ -906,41 +1589,26 @@ class DFpdf(object):
                     title = None
 
                 last = rec
+                auditList = []
 
-                auditList = [[
-                    Paragraph('<para alignment="right"><b>Field</b></para>', styleN),
-                    Paragraph('<b>Description</b>', styleN),
-                    Paragraph('<b>Operation</b>', styleN)]]
-
-            changes = []
-            for o in rec.ops:
-                changes.append(Paragraph(o, styleI))
             if rec.fnum < 0:
-                auditList.append([
-                    Paragraph('<para alignment="right">- .</para>', styleN),
-                    Paragraph('{0}'.format(rec.desc), styleN),
-                    changes])
+                fnum = '- .'
             elif rec.fnum == 0:
-                auditList.append([
-                    Paragraph('<para alignment="right"></para>', styleN),
-                    Paragraph('{0}'.format(rec.desc), styleN),
-                    changes])
+                fnum = ''
             else:
-                auditList.append([
-                    Paragraph('<para alignment="right">{0}.</para>'.format(rec.fnum), styleN),
-                    Paragraph('{0}'.format(rec.desc), styleN),
-                    changes])
+                fnum = '{0}.'.format(rec.fnum)
+            auditList.append(ListingRow([
+                fnum,
+                '{0}'.format(rec.desc),
+                list(rec.ops)], None, None))
 
         # If we still have remaining audit records, output them now.
         if auditList:
-            table = Table(auditList, colWidths=[
+            table = ListingTable([
                 0.1*width,
                 0.3*width,
-                0.6*width], splitByRow=1, repeatRows=1, hAlign='LEFT')
-            tablestyle = TableStyle([
-                ('VALIGN', (0,0), (-1, -1), 'TOP'),
-                ('LINEABOVE', (0,0), (-1, -1), 1, lightgrey)])
-            table.setStyle(tablestyle)
+                0.6*width], (TA_RIGHT, TA_LEFT, TA_LEFT), header,
+                auditList, styleN, styleI)
             if title:
                 self.content.append(KeepTogether([ title, \
                 Paragraph('{0} {1} {2}'.format(last.tdate, last.ttime, last.who), styleA), table]))
@@ -959,8 +1627,8 @@ class DFpdf(object):
     # Output CRF Image
     #########################################################################
     def outputCRFImage(self, record):
-        self.content.append(DFcrf(None, self.study, record, self.hide_internal,\
-                self.redaction_dict, self.prefer_background, self.setPageHeader))
+        self.content.append(DFcrf(None, self.study, record, self.plans,
+                self.images, self.setPageHeader))
         self.content.append(PageBreak())
 
     #########################################################################
@@ -970,10 +1638,7 @@ class DFpdf(object):
         rasters.sort()
         for doc_num, (raster, is_primary) in enumerate(rasters, 1):
             doc_type = 'Primary' if is_primary else 'Secondary'
-            paths = []
-            if self.shadow_pages:
-                paths.append(os.path.join(self.shadow_pages, raster))
-            paths.append(os.path.join(self.study.studydir, 'pages', raster))
+            paths = rasterPaths(self.shadow_pages, self.study.studydir, raster)
             for path in paths:
                 if os.path.isfile(path) and os.access(path, os.R_OK):
                     break
@@ -981,24 +1646,27 @@ class DFpdf(object):
                 print(' {0},{1},{2} image {3} not found or is not a readable file'.format(pid_num, visit_num, plate_num, path))
                 return
 
-            # Try to determine if this is a PDF file
-            with open(path, 'rb') as f:
-                mtime = time.strftime('%Y/%m/%d %H:%M:%S',
-                        time.localtime(os.path.getmtime(path)))
-                if f.read(4) == str('%PDF'):
-                    pages = PdfReader(path).pages
-                    try:
-                        pages = [pagexobj(x) for x in pages]
-                        for page_num, page in enumerate(pages, 1):
-                            label = 'Attached Document {0} ({1}, PDF, Page {2} of {3}) dated {4}'.format(doc_num, doc_type, page_num, len(pages), mtime)
-                            self.content.append(DFXObj(None, page, label))
-                            self.content.append(PageBreak())
-                    except:
-                        print(' {0},{1},{2} image {3} is incompatible PDF'.format(pid_num, visit_num, plate_num, path))
-                else:
-                    label = 'Attached Document {0} ({1}, Single Image) dated {2}'.format(doc_num, doc_type, mtime)
-                    self.content.append(DFimage(None, path, label))
+            if self.streaming:
+                self.volumeBytes += os.path.getsize(path)
+
+            mtime = time.strftime('%Y/%m/%d %H:%M:%S',
+                    time.localtime(os.path.getmtime(path)))
+            kind, parsed = self.attachments.lookup(path)
+            if kind == 'pdf':
+                if parsed is None:
+                    print(' {0},{1},{2} image {3} is incompatible PDF'.format(pid_num, visit_num, plate_num, path))
+                    continue
+                for page_num, page in enumerate(parsed, 1):
+                    label = 'Attached Document {0} ({1}, PDF, Page {2} of {3}) dated {4}'.format(doc_num, doc_type, page_num, len(parsed), mtime)
+                    self.content.append(DFXObj(None, page, label))
                     self.content.append(PageBreak())
+            else:
+                label = 'Attached Document {0} ({1}, Single Image) dated {2}'.format(doc_num, doc_type, mtime)
+                if parsed is not None:
+                    self.images.submit(path, parsed)
+                self.content.append(DFimage(None, path, label, parsed,
+                        self.images))
+                self.content.append(PageBreak())
 
     #########################################################################
     # Output Field Values
@@ -1006,6 +1674,7 @@ class DFpdf(object):
     def outputFieldValues(self, width, record):
         styleH = self.styles['title']
         styleN = self.styles['default']
+        styleI = self.styles['indented']
         field_values = record.split('|')
         pid_num = int(field_values[6])
         visit_num = int(field_values[5])
@@ -1019,10 +1688,7 @@ class DFpdf(object):
             return
 
         if not is_lost and not is_deleted:
-            fieldValueList = [[
-                Paragraph('<para alignment="right"><b>Field</b></para>', styleN),
-                Paragraph('<b>Description</b>', styleN),
-                Paragraph('<b>Value</b>', styleN)]]
+            fieldValueList = []
             for field in plate.fieldList():
                 bb = field.boundingBox()
                 if bb is None:
@@ -1058,15 +1724,13 @@ class DFpdf(object):
 
                 bookmark = '{0}_{1}_{2}_{3}'.format(pid_num, visit_num, plate_num, field.number)
                 if self.include_field_audit:
-                    fieldValueList.append([
-                        Paragraph('<para alignment="right"><a name="{0}"/>{1}.</para>'.format(bookmark, field.number), styleN),
-                        Paragraph(description, styleN),
-                        Paragraph('<para><a href="#{0}_audit" color="blue">{1}</a></para>'.format(bookmark, list_value), styleN)])
+                    link = '{0}_audit'.format(bookmark)
                 else:
-                    fieldValueList.append([
-                        Paragraph('<para alignment="right"><a name="{0}"/>{1}.</para>'.format(bookmark, field.number), styleN),
-                        Paragraph(description, styleN),
-                        Paragraph('<para>{0}</para>'.format(list_value), styleN)])
+                    link = None
+                fieldValueList.append(ListingRow([
+                    '{0}.'.format(field.number),
+                    description,
+                    list_value], bookmark, link))
 
         bookmark = '{0}_{1}_{2}_DA'.format(pid_num, visit_num, plate_num)
         self.content.append(Paragraph('<a name="{0}"/>Data Field Values'.format(bookmark), styleH))
@@ -1081,14 +1745,13 @@ class DFpdf(object):
             self.content.append(Paragraph('Record Deleted<br/><i>{0}</i>'.format(
                 self.escape_string(field_values[7])), styleN))
         else:
-            table = Table(fieldValueList, colWidths=[
+            table = ListingTable([
                 0.1*width,
                 0.3*width,
-                0.6*width], splitByRow=1, repeatRows=1, hAlign='LEFT')
-            tablestyle = TableStyle([
-                ('VALIGN', (0,0), (-1, -1), 'TOP'),
-                ('LINEABOVE', (0,0), (-1, -1), 1, lightgrey)])
-            table.setStyle(tablestyle)
+                0.6*width], (TA_RIGHT, TA_LEFT, TA_LEFT), [
+                '<b>Field</b>',
+                '<b>Description</b>',
+                '<b>Value</b>'], fieldValueList, styleN, styleI)
             self.content.append(table)
         #self.content.append(PageBreak())
 
@@ -1097,6 +1760,11 @@ class DFpdf(object):
     # list of data values, chronological audit and field based audit
     ###########################################################################
     def outputPatientRecord(self, pid_num, visit_num, plate_num, datarec):
+        if self.streaming and self.doc is None:
+            self.startVolume()
+        plan = self.plans.plan(plate_num, visit_num)
+        if plan is not None and plan.background is not None:
+            self.images.submit(plan.background[0], plan.background[1:])
         self.outputCRFImage(datarec)
         raster = datarec[4:16]
         if self.include_attached_images.contains(plate_num) and \
@@ -1114,232 +1782,77 @@ class DFpdf(object):
         if self.include_field_audit:
             self.outputFieldAudit(6.4*inch, pid_num, visit_num, plate_num, auditOps)
 
+        if self.streaming:
+            self.writeContent()
+            self.volumeRecords.append((pid_num, visit_num, plate_num, None,
+                datarec))
+            if (self.volume_pages and self.doc.page >= self.volume_pages) or \
+                    (self.volume_bytes and \
+                    self.volumeBytes >= self.volume_bytes):
+                self.endVolume()
+
     ###########################################################################
     # escape_string - Escape special characters
     ###########################################################################
     def escape_string(self, s):
-        s=s.replace('&', '&amp;')
-        s=s.replace('<', '&lt;')
-        s=s.replace('>', '&gt;')
-        return s;
+        return audittrail.escapeString(s)
 
     ###########################################################################
     # find_secondaries - Get a list of secondary raster images for keys
     ###########################################################################
     def find_secondaries(self, pid_num, visit_num, plate_num):
-        secondaries_cursor = self.sql.execute('''
-            select raster from secondaries
-            where pid=? and visit=? and plate=?''',
-            (pid_num, visit_num, plate_num))
-        return [r[0] for r in secondaries_cursor.fetchall()]
+        if self.secondaries_pid != pid_num:
+            self.secondaries = self.patientRows(
+                closeoutdb.PATIENT_SECONDARIES_SELECT, pid_num)
+            self.secondaries_pid = pid_num
+        return [r[0] for r in self.secondaries.get((visit_num, plate_num), [])]
+
+    ###########################################################################
+    # patientRows - Run one of the closeoutdb.PATIENT_*_SELECT queries for a
+    # patient and partition the rows by (visit, plate), leaving those two
+    # columns out
+    ###########################################################################
+    def patientRows(self, query, pid_num):
+        rows = {}
+        cursor = self.sql.execute(query, (pid_num,))
+        for (key, group) in groupby(cursor, lambda r: (r[0], r[1])):
+            rows[key] = [r[2:] for r in group]
+        return rows
 
     ###########################################################################
     # parseAudit: Convert Audit to human readable form
     ###########################################################################
     def parseAudit(self, pid_num, visit_num, plate_num):
-        auditRec = namedtuple('auditRec', '''who, tdate, ttime, status, op,
-            type, funiqueid, fnum, metafnum, code, reason, desc, oldval, newval,
-            oldvaldec, newvaldec''')
-        audit_cursor = self.sql.execute('''
-            select
-		        a.who, a.tdate, a.ttime, a.status, a.op, a.type, a.funiqueid, a.fnum,
-                a.metafnum, a.code, a.reason, s.string, a.oldval, a.newval, a.oldvaldec,
-		        a.newvaldec
-            from audit a join shared_strings s
-            on a.fdescid = s.id
-            where a.pid=? and a.visit=? and a.plate=?
-            order by a.tdate, a.ttime''', \
-            (pid_num, visit_num, plate_num))
-        auditRecs = map(auditRec._make, audit_cursor.fetchall())
-
-        # Group audit records into data/reason/qc transactions. Sometimes
-        # data/reason/qc records have slightly different timestamps because
-        # of how the server writes them out.
-        groupedAuditRecs = []
-        last = None
-        lastTime = 0
-        for rec in auditRecs:
-            thisTime = int(rec.ttime[0:2])*3600 + int(rec.ttime[2:4])*60 + \
-                    int(rec.ttime[4:6])
-            if last is None or last.who != rec.who or last.tdate != rec.tdate \
-                    or (lastTime != thisTime and lastTime != (thisTime-1)):
-                    last = rec
-                    lastTime = thisTime
-
-            funiqueid = rec.funiqueid
-
-            if rec.fnum is None or rec.fnum == '':
-                fnum = 0
+        # The whole patient's audit trail is read with their first record
+        if self.audit_pid != pid_num:
+            if self.audit_txn:
+                query = closeoutdb.PATIENT_AUDIT_TXN_SELECT
             else:
-                fnum = int(rec.fnum)
+                query = closeoutdb.PATIENT_AUDIT_SELECT
+            self.audit_rows = self.patientRows(query, pid_num)
+            self.audit_pid = pid_num
+        rows = self.audit_rows.get((visit_num, plate_num), [])
+
+        # Use the transactions make_closeout_db --audit-txn prepared, if any
+        if self.audit_txn:
+            auditOps = [audittrail.AuditTxn(who, tdate, ttime, funiqueid, fnum,
+                desc, ops.split('\n')) for (who, tdate, ttime, funiqueid, fnum,
+                desc, ops) in rows]
+        else:
+            auditOps = self.audit_trail.transactions(rows)
 
-            # For deleted records, get reason from DFPLATE and mark
-            # it for all fields (funique=0 and fnum=0)
-            if rec.type == 'r' and rec.funiqueid <5100 and rec.metafnum == 0:
-                funiqueid = 0
-                fnum = 0
-            
-            # For key changes, get reason from PID and mark it for all
-            # fields
-            #if rec.type == 'r' and rec.op == 'N' and rec.fnum == 7 and \
-            #        rec.reason[:12] == 'Keys changed':
-            #    funiqueid = 0
-            #    fnum = 0
-            #    print('KeyChange ', rec)
-
-            groupedAuditRecs.append(auditRec(rec.who, \
-                    rec.tdate[0:4]+'/'+rec.tdate[4:6]+'/'+rec.tdate[6:8], \
-                    last.ttime[0:2]+':'+last.ttime[2:4]+':'+last.ttime[4:6], \
-                    rec.status, rec.op, rec.type, funiqueid, fnum, \
-                    rec.metafnum, rec.code, rec.reason, rec.desc, rec.oldval, \
-                    rec.newval, rec.oldvaldec, rec.newvaldec))
-
-        auditRecs = sorted(groupedAuditRecs, key=lambda x: \
-                (x.tdate, x.ttime, abs(x.fnum), x.type, x.metafnum))
-
-        # Now group operations by fields
-        auditOpRec = namedtuple('auditOpRec', '''who, tdate, ttime,
-                funiqueid, fnum, desc, ops''')
-        auditOps = []
+        # Leave out internal and redacted fields
         field_dict = self.study.fieldsByUniqueID()
-        last = None
-        desc = ''
-        blind = False
-        # Process each audit record and group them into transactions
-        for rec in auditRecs:
-            if last is None or last.who != rec.who or last.tdate != rec.tdate or \
-                    last.ttime != rec.ttime or last.funiqueid != rec.funiqueid:
-                if last is not None and ops:
-                    auditOps.append(auditOpRec(last.who, last.tdate, last.ttime, \
-                            last.funiqueid, last.fnum, desc, ops))
-                last = rec
-                blind = False
-                field = field_dict.get(rec.funiqueid)
-                # Check whether this is an internal field
-                if field and ((self.redaction_dict and \
-                    self.redaction_dict.get((plate_num, field.number))) or \
-                    (self.hide_internal and field.isBlinded())):
-                    blind = True
-                    desc = 'Internal Use Only Field'
-                else:
-                    blind = False
-                    desc = self.escape_string(last.desc)
-                ops = []
-    
-            # Skip system fields
-            if rec.funiqueid >0 and rec.funiqueid < 10000:
-                continue
-    
-            # Skip blinded fields
-            if blind:
+        visibleOps = []
+        for txn in auditOps:
+            field = field_dict.get(txn.funiqueid)
+            if field and ((self.redaction_dict and \
+                self.redaction_dict.get((plate_num, field.number))) or \
+                (self.hide_internal and field.isBlinded())):
                 continue
+            visibleOps.append(txn)
 
-            ###############################################################
-            # DATA RECORDS
-            ###############################################################
-            if rec.type == 'd':
-                missingLabel = self.study.missingValueLabel(rec.oldval)
-                if missingLabel is not None:
-                    oldval = '[' + rec.oldval + ', ' + missingLabel + ']'
-                else:
-                    if rec.oldval != '' and rec.oldvaldec != '':
-                        oldval = rec.oldval + ', ' + rec.oldvaldec
-                    else:
-                        oldval = rec.oldval
-    
-                    if oldval == "":
-                        oldval = '[blank]'
-    
-    
-                missingLabel = self.study.missingValueLabel(rec.newval)
-                if missingLabel is not None:
-                    newval = '[' + rec.newval + ', ' + missingLabel + ']'
-                else:
-                    if rec.newval != '' and rec.newvaldec != '':
-                        newval = rec.newval + ', ' + rec.newvaldec
-                    else:
-                        newval = rec.newval
-    
-                    if newval == "":
-                        newval = '[blank]'
-    
-                if rec.op == 'N':
-                    if rec.status == 0:
-                        reason = self.lost_codes.get(rec.code, 'Other')
-                        if rec.reason:
-                            reason = reason + ' [' + rec.reason + ']'
-                        ops.append('Data Record marked Lost: {0}'.format(reason))
-                    else:
-                        newval = self.escape_string(newval)
-                        ops.append('Initial Value: <b>{0}</b>'.format(newval))
-                elif rec.op == 'C':
-                    oldval = self.escape_string(oldval)
-                    newval = self.escape_string(newval)
-                    if len(oldval) > 100 or len(newval) > 100:
-                        ops.append('Changed Value: <b>{0}</b>'.format(newval))
-                    else:
-                        ops.append('Changed Value: <b>{0} \u2192 {1}</b>'.format(oldval, newval))
-                elif rec.op == 'D':
-                    ops.append('Data Record Deleted')
-    
-            ###############################################################
-            # QC RECORDS
-            ###############################################################
-            if rec.type == 'q':
-                if rec.metafnum not in [0,1,12,17,18]:
-                    continue
-                qctype = self.study.qcType(rec.code)
-                qcstatus = self.study.qcStatus(rec.status, False)
-                label = ''
-                value = self.escape_string(rec.newval)
-                if rec.metafnum == 1:
-                    label = "Status"
-                    value = qcstatus
-                    if rec.status in [2, 6]:
-                        continue
-                elif rec.metafnum == 12:
-                    label = "Reply"
-                    if rec.op == 'N' and not rec.newval:
-                        continue
-                elif rec.metafnum == 17:
-                    label = "Query"
-                elif rec.metafnum == 18:
-                    if rec.op == 'N' and not rec.newval:
-                        continue
-                    label = "Note"
-                if rec.op == 'N' or rec.op == 'C':
-                    ops.append('QC {0} ({1}): <i>{2}</i>'.format(label, qctype, \
-                            value))
-                elif rec.op == 'D':
-                    ops.append('QC Deleted ({0})'.format(qctype))
-    
-            ###############################################################
-            # REASON RECORDS
-            ###############################################################
-            if rec.type == 'r':
-                if rec.metafnum not in [0, 1, 10]:
-                    continue
-                if rec.op == 'N' or rec.op == 'C':
-                    s = self.study.reasonStatus(rec.status)
-                    if rec.metafnum == 0:
-                        ops.append('<i>{0}</i>'.format(rec.reason))
-                    if rec.metafnum == 1:
-                        ops.append('Reason Status: <i>{0}</i>'.format(s))
-                    if rec.metafnum == 10:
-                        newval = self.escape_string(rec.newval)
-                        ops.append('Reason Text: <i>{0}</i>'.format(newval))
-                elif rec.op == 'D':
-                    if rec.metafnum == 0 and rec.funiqueid < 5100:
-                        ops.append('<i>{0}</i>'.format(rec.reason))
-                    else:
-                        ops.append('Reason Deleted')
-    
-        # Add last transaction to list
-        if last is not None and ops:
-            auditOps.append(auditOpRec(last.who, last.tdate, last.ttime, \
-                last.funiqueid, last.fnum, desc, ops))
-    
-        return auditOps
+        return visibleOps
 
 ############################################################################
 # loadRedactionFile
@@ -1368,6 +1881,592 @@ def loadRedactionFile(filename):
 
     return redaction_dict
 
+############################################################################
+# databaseSettings - Check that closeout can read a database and work out
+# how. Options the database cannot support are turned off with a warning.
+# Returns (include_secondaries, include_deleted, audit_txn, ordered,
+# follow).
+############################################################################
+def databaseSettings(db, sql, studydir, include_secondaries, include_deleted,
+        follow):
+    schema = closeoutdb.Schema(sql)
+    if schema.version > closeoutdb.SCHEMA_VERSION:
+        print('ERROR: {0} was built by a newer version of make_closeout_db'.format(db))
+        sys.exit(2)
+    if not schema.current():
+        print('ERROR: {0} was built by an older version of make_closeout_db.'.format(db))
+        print('       Upgrade it with make_closeout_db --upgrade')
+        sys.exit(2)
+
+    if include_secondaries and not schema.has('secondaries'):
+        print('WARNING: --include-secondaries specified, but intermediate database does not')
+        print('         contain any secondary image data')
+        include_secondaries = False
+
+    if include_deleted and not schema.has('deleted'):
+        print('WARNING: --include-deleted specified, but intermediate database does not')
+        print('         contain any deleted record data')
+        include_deleted = False
+
+    # Grouped audit transactions are only used if they were rendered with
+    # the same study setup as this run
+    audit_txn = schema.has('audit_txn')
+    if audit_txn and closeoutdb.buildInfo(sql).get('audit_txn_setup') != \
+            closeoutdb.setupDigest(studydir):
+        print('WARNING: audit transactions in {0} were grouped with a different'.format(db))
+        print('         study setup, using the audit trail instead. Regroup them')
+        print('         with make_closeout_db --upgrade --audit-txn')
+        audit_txn = False
+
+    # Records come out of the database in display order if
+    # make_closeout_db was given the study setup
+    ordered = schema.has('data.display_order')
+
+    if follow and not schema.has('patients_ready'):
+        print('WARNING: --follow specified, but intermediate database was not built')
+        print('         by a version of make_closeout_db that supports it')
+        follow = False
+
+    return (include_secondaries, include_deleted, audit_txn, ordered, follow)
+
+############################################################################
+# patientIDs - Generate the IDs of patients to output. When following a
+# pipelined make_closeout_db build, keep polling for newly loaded patients
+# until the build is complete.
+############################################################################
+def patientIDs(sql, clauses, follow, poll_interval):
+    if not follow:
+        for pid in sql.execute(closeoutdb.patientSelect(clauses)).fetchall():
+            yield pid
+        return
+
+    last_pid = 0
+    while True:
+        complete = closeoutdb.buildComplete(sql)
+        for pid in sql.execute(closeoutdb.readyPatientSelect(clauses),
+                {'last': last_pid}).fetchall():
+            last_pid = pid[0]
+            yield pid
+        if complete:
+            return
+        time.sleep(poll_interval)
+
+############################################################################
+# PatientRenderer - Output the PDF file for one patient. With --jobs, the
+# renderer and the Study it holds are loaded once and shared by the worker
+# processes, which open their own read-only database connections.
+############################################################################
+class PatientRenderer(object):
+    def __init__(self, study, blinded, redaction_dict, include_attached_images,
+            prefer_background, shadow_pages, format_pid,
+            include_chronological_audit, include_field_audit, fontsize,
+            leading, quiet, volume_pages, volume_bytes, images, incremental,
+            config_digest):
+        self.study = study
+        self.blinded = blinded
+        self.redaction_dict = redaction_dict
+        self.include_attached_images = include_attached_images
+        self.plans = CRFPlanTable(study, BackgroundTable(study.studydir,
+            prefer_background), blinded, redaction_dict)
+        self.attachments = AttachmentCache(ATTACHMENT_CACHE_BYTES)
+        self.images = images
+        self.shadow_pages = shadow_pages
+        self.format_pid = format_pid
+        self.include_chronological_audit = include_chronological_audit
+        self.include_field_audit = include_field_audit
+        self.fontsize = fontsize
+        self.leading = leading
+        self.quiet = quiet
+        self.volume_pages = volume_pages
+        self.volume_bytes = volume_bytes
+        self.incremental = incremental
+        self.config_digest = config_digest
+        self.visitmap = study.visitMap()
+        self.connections = {}
+
+    def connection(self, db):
+        '''Returns this process's connection to db'''
+        sql = self.connections.get(db)
+        if sql is None:
+            sql = sqlite3.connect(db)
+            sql.execute('pragma query_only=1')
+            self.connections[db] = sql
+        return sql
+
+    ########################################################################
+    # patientDigest - Hash everything a patient's PDF is made from: the
+    # run's configuration, the patient's records, audit trail and
+    # secondaries, and the size and time of their attachments
+    ########################################################################
+    def patientDigest(self, sql, pid, sortedRecs, rec_select,
+            include_secondaries, audit_txn):
+        digest = hashlib.sha1(self.config_digest)
+        digest.update(repr((rec_select, include_secondaries, audit_txn)))
+        for rec in sortedRecs:
+            digest.update(repr(rec))
+
+        if self.include_chronological_audit or self.include_field_audit:
+            if audit_txn:
+                query = closeoutdb.PATIENT_AUDIT_TXN_SELECT
+            else:
+                query = closeoutdb.PATIENT_AUDIT_SELECT
+            hashRows(digest, sql.execute(query, (pid,)))
+
+        rasters = [(visit_num, plate_num, datarec[4:16]) for (pid_num,
+                visit_num, plate_num, plateorder, datarec) in sortedRecs]
+        if include_secondaries:
+            secondaries = sql.execute(closeoutdb.PATIENT_SECONDARIES_SELECT,
+                    (pid,)).fetchall()
+            hashRows(digest, secondaries)
+            rasters.extend(secondaries)
+        for (visit_num, plate_num, raster) in rasters:
+            if not self.include_attached_images.contains(plate_num) or \
+                    raster[4:5] != '/' or raster == '0000/0000000':
+                continue
+            for path in rasterPaths(self.shadow_pages, self.study.studydir,
+                    raster):
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                digest.update(repr((path, st.st_mtime, st.st_size)))
+
+        return digest.hexdigest()
+
+    ########################################################################
+    # estimate - Size a patient's PDF without laying it out, from record,
+    # audit and secondary counts and the attachment files. Only the rasters
+    # of plates with attached images are read from the records. Returns
+    # the number of records, pages, attachments, attachment bytes and
+    # audit rows.
+    #
+    # A record is a page for the CRF and a page for each attachment page.
+    # The field values and audit sections run on from one another, so
+    # their lines are added up over the patient's records and rounded up
+    # to pages once. They take a line for each field and
+    # ESTIMATE_AUDIT_LINES for each audit row in each audit section.
+    ########################################################################
+    ESTIMATE_AUDIT_LINES = 3
+
+    def estimate(self, sql, pid, clauses, include_deleted,
+            include_secondaries):
+        lines_per_page = 8.4*inch / self.leading
+        audit_sections = int(self.include_chronological_audit) + \
+                int(self.include_field_audit)
+        audit_counts = {}
+        if audit_sections:
+            for (visit_num, plate_num, count) in sql.execute(
+                    closeoutdb.PATIENT_AUDIT_COUNTS, (pid,)):
+                audit_counts[(visit_num, plate_num)] = count
+        secondaries = {}
+        if include_secondaries:
+            for (visit_num, plate_num, raster) in sql.execute(
+                    closeoutdb.PATIENT_SECONDARIES_SELECT, (pid,)):
+                secondaries.setdefault((visit_num, plate_num),
+                        []).append(raster)
+
+        records = pages = attachments = attachment_bytes = audit_rows = 0
+        lines = 0
+        for (visit_num, plate_num, count) in sql.execute(
+                closeoutdb.recordCountSelect(clauses, include_deleted),
+                {'pid': pid}):
+            records += count
+            pages += count
+
+            plate = self.study.plate(plate_num)
+            fields = 0
+            if plate is not None:
+                fields = len([f for f in plate.fieldList()
+                    if f.boundingBox() is not None])
+            rows = audit_counts.get((visit_num, plate_num), 0)
+            audit_rows += rows
+            lines += count * (fields + 1) + \
+                    self.ESTIMATE_AUDIT_LINES * rows * audit_sections
+
+        pages += int(math.ceil(lines / lines_per_page))
+
+        attached_clause = self.include_attached_images.toSQL('plate')
+        if attached_clause is None:
+            rasters = []
+        else:
+            rasters = sql.execute(closeoutdb.recordRasterSelect(
+                clauses + [attached_clause], include_deleted), {'pid': pid})
+        for (visit_num, plate_num, raster) in rasters:
+            if isinstance(raster, buffer):
+                raster = closeoutdb.unpack(raster)[4:16]
+            if raster[4:5] != '/' or raster == '0000/0000000':
+                continue
+            for r in [raster] + secondaries.get((visit_num, plate_num), []):
+                found = self.attachmentSize(r)
+                if found is None:
+                    continue
+                (count, size) = found
+                attachments += 1
+                pages += count
+                attachment_bytes += size
+
+        return (records, pages, attachments, attachment_bytes, audit_rows)
+
+    def attachmentSize(self, raster):
+        '''Returns the pages and bytes of an attachment, without parsing
+        more of it than a PDF's page tree, or None if there is no file'''
+        for path in rasterPaths(self.shadow_pages, self.study.studydir,
+                raster):
+            if os.path.isfile(path) and os.access(path, os.R_OK):
+                break
+        else:
+            return None
+
+        size = os.path.getsize(path)
+        with open(path, 'rb') as f:
+            is_pdf = f.read(4) == str('%PDF')
+        if not is_pdf:
+            return (1, size)
+        try:
+            return (len(PdfReader(path).pages), size)
+        except:
+            return (0, size)
+
+    ########################################################################
+    # render - Output a patient's records. Returns 1 if the PDF could not
+    # be laid out, 0 otherwise.
+    ########################################################################
+    def render(self, sql, pid, center_number, rec_select, ordered,
+            include_secondaries, audit_txn):
+        retcode = 0
+        print('Site {0} Patient {1}'.format(center_number, pid))
+        try:
+            os.mkdir('{0}'.format(center_number))
+        except OSError:
+            pass
+
+        rec_cursor = sql.execute(rec_select, {'pid': pid})
+        sortedRecs=[]
+
+        # For each record, get its plate display order
+        for (pid_num, visit_num, plate_num, datarec, display_order) in \
+                rec_cursor:
+            datarec = closeoutdb.unpack(datarec)
+            if display_order is None:
+                display_order = closeoutdb.displayOrder(self.visitmap,
+                        visit_num, plate_num)
+            plateorder = display_order // 1000 % 1000
+
+            sortedRecs.append((pid_num, visit_num, plate_num, plateorder, datarec))
+
+        # Sort by visit, plate display order, plate
+        if not ordered:
+            sortedRecs.sort(key=lambda x: (x[1], x[3], x[2]))
+
+        # With --incremental, skip the patient if nothing has changed since
+        # the last run
+        name = formatPID(self.format_pid, pid)
+        manifest_path = os.path.join(str(center_number), name + '.manifest')
+        if self.incremental:
+            manifest = readManifest(manifest_path)
+            digest = self.patientDigest(sql, pid, sortedRecs, rec_select,
+                    include_secondaries, audit_txn)
+            if manifest.get('digest') == digest and all([os.path.exists(f) \
+                    for f in manifest.get('files', [])]):
+                print('Unchanged since last run')
+                return retcode
+
+        pdf = DFpdf(str(center_number), name,
+                sql, self.study, self.blinded, self.redaction_dict,
+                self.include_attached_images, self.plans,
+                self.attachments, self.images, self.shadow_pages,
+                self.format_pid,
+                self.include_chronological_audit, self.include_field_audit,
+                self.fontsize, self.leading, include_secondaries, audit_txn,
+                self.volume_pages, self.volume_bytes)
+
+        pdf.generateBookmarksForPatient(sortedRecs)
+
+        # Now traverse sorted list and output records. In streaming mode
+        # they are laid out as they are output.
+        try:
+            for (pid_num, visit_num, plate_num, plateorder, datarec) in \
+                    sortedRecs:
+                if not self.quiet:
+                    print("  ", pid_num, visit_num, plate_num)
+                pdf.outputPatientRecord(pid_num, visit_num, plate_num, datarec)
+
+            # Actually build the PDF file based on the content generated above
+            print('Writing out PDF file...')
+            pdf.close(self.quiet)
+        except LayoutError as e:
+            print('****** ERROR: Unable to layout page for',
+                    pdf.headerId, 'Visit', pdf.headerVisitNum,
+                    '({0})'.format(pdf.headerVisitLabel),
+                    'Plate', pdf.headerPlateNum,
+                    '({0})'.format(pdf.headerPlateLabel))
+            if not self.quiet:
+                print('    ',e)
+            print('****** Try using a smaller font using --font-size and --leading options')
+            retcode = 1
+
+        # Record what the PDF was made from, removing volumes the last run
+        # wrote that this one did not. A manifest left by an earlier
+        # --incremental run no longer describes the files otherwise.
+        if self.incremental and retcode == 0:
+            files = pdf.files()
+            for f in manifest.get('files', []):
+                if f not in files and os.path.exists(f):
+                    os.remove(f)
+            writeManifest(manifest_path, {'digest': digest, 'files': files})
+        elif os.path.exists(manifest_path):
+            os.remove(manifest_path)
+        return retcode
+
+def serveInWorker(task):
+    '''Render a patient for the --serve service in a worker process, in a
+    directory of its own. Returns the console output, the return code and
+    the PDF, which is None if the patient has no records. Errors are
+    returned as console output with a return code of 1.'''
+    (db, pid, center_number, rec_select, ordered, include_secondaries,
+        audit_txn) = task
+    output = StringIO()
+    stdout = sys.stdout
+    sys.stdout = output
+    workdir = tempfile.mkdtemp(prefix='closeout')
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    pdf = None
+    try:
+        sql = worker_renderer.connection(db)
+        if sql.execute(rec_select, {'pid': pid}).fetchone() is None:
+            return ('', 0, None)
+        code = worker_renderer.render(sql, pid, center_number, rec_select,
+                ordered, include_secondaries, audit_txn)
+        if code == 0:
+            with open(os.path.join(str(center_number), formatPID(
+                    worker_renderer.format_pid, pid) + '.pdf'), 'rb') as f:
+                pdf = f.read()
+    except Exception:
+        # Anything else is reported to the client rather than dropping
+        # its connection
+        traceback.print_exc(file=output)
+        code = 1
+    finally:
+        sys.stdout = stdout
+        os.chdir(cwd)
+        shutil.rmtree(workdir, True)
+    return (output.getvalue(), code, pdf)
+
+############################################################################
+# RenderService - Render single patients on request, for closeout --serve.
+# The study, backgrounds and font metrics are loaded once and shared by a
+# pool of --jobs worker processes, which keep their database connections
+# open between requests. Requests are taken by a thread each, so several
+# patients can be rendered at once.
+#
+#   GET /patients/PID   the patient's PDF
+#   GET /health         ok
+############################################################################
+class RenderService(object):
+    def __init__(self, renderer, centerdb, centers, dbs, catalog, shards,
+            record_clauses, include_secondaries, include_deleted, jobs):
+        self.centerdb = centerdb
+        self.centers = centers
+        self.dbs = dbs
+        self.catalog = catalog
+        self.shards = shards
+        self.settings = {}
+        for db in dbs:
+            sql = sqlite3.connect(db)
+            (secondaries, deleted, audit_txn, ordered, follow) = \
+                    databaseSettings(db, sql, renderer.study.studydir,
+                    include_secondaries, include_deleted, False)
+            sql.close()
+            self.settings[db] = (closeoutdb.recordSelect(record_clauses,
+                deleted, ordered), ordered, secondaries, audit_txn)
+
+        # Load the metrics of the fonts used before the workers fork
+        for font in ['Helvetica', 'Helvetica-Bold', 'Helvetica-Oblique',
+                'Helvetica-BoldOblique']:
+            pdfmetrics.getFont(font)
+        self.pool = multiprocessing.Pool(max(jobs, 1), initWorker,
+                (renderer,))
+
+    def database(self, pid):
+        '''Returns the database holding a patient, or None'''
+        if self.catalog is None:
+            return self.dbs[0]
+        for path in closeoutdb.shardPaths(self.catalog, self.shards,
+                'pid={0}'.format(pid), self.centers):
+            if path in self.settings:
+                return path
+        return None
+
+    def render(self, pid):
+        '''Returns the HTTP status, content type and body for a patient'''
+        center_number = self.centerdb.centerNumber(pid)
+        db = self.database(pid)
+        if (self.centers and not self.centers.contains(center_number)) or \
+                db is None:
+            return (404, 'text/plain', 'Patient {0} not found\n'.format(pid))
+
+        (rec_select, ordered, include_secondaries, audit_txn) = \
+                self.settings[db]
+        (output, code, pdf) = self.pool.apply(serveInWorker, ((db, pid,
+            center_number, rec_select, ordered, include_secondaries,
+            audit_txn),))
+        if code != 0:
+            return (500, 'text/plain', output)
+        if pdf is None:
+            return (404, 'text/plain', 'Patient {0} not found\n'.format(pid))
+        return (200, 'application/pdf', pdf)
+
+class ServiceHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        parts = self.path.split('?')[0].strip('/').split('/')
+        if parts == ['health']:
+            self.reply(200, 'text/plain', 'ok\n')
+            return
+        if len(parts) != 2 or parts[0] != 'patients':
+            self.reply(404, 'text/plain', 'Not found\n')
+            return
+        try:
+            pid = int(parts[1])
+        except ValueError:
+            self.reply(400, 'text/plain', 'Bad patient ID\n')
+            return
+        self.reply(*self.server.service.render(pid))
+
+    def reply(self, status, content_type, body):
+        if isinstance(body, unicode):
+            body = body.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        # Unix socket clients have no address, and skip the DNS lookup
+        if isinstance(self.client_address, tuple):
+            return self.client_address[0]
+        return 'local'
+
+    def log_message(self, format, *args):
+        sys.stderr.write('{0} - - [{1}] {2}\n'.format(self.address_string(),
+            self.log_date_time_string(), format % args))
+
+class ServiceServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+class UnixServiceServer(SocketServer.ThreadingMixIn,
+        SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+def serve(address, service):
+    '''Serve requests on address, a port or host:port, or the path of a
+    Unix socket, until interrupted'''
+    if '/' in address:
+        try:
+            if stat.S_ISSOCK(os.stat(address).st_mode):
+                os.remove(address)
+        except OSError:
+            pass
+        server = UnixServiceServer(address, ServiceHandler)
+    else:
+        (host, sep, port) = address.rpartition(':')
+        server = ServiceServer((host or '127.0.0.1', int(port)),
+                ServiceHandler)
+    server.service = service
+    print('Serving on', address)
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+    service.pool.terminate()
+
+############################################################################
+# Incremental runs - With --incremental, each patient's PDF has a manifest
+# next to it, with a digest of what it was made from and the files written.
+# Other runs neither read nor write manifests.
+############################################################################
+STUDY_FILES = ['lib/DFserver.cf', 'lib/DFsetup', 'lib/DFvisit_map',
+    'lib/DFpage_map', 'lib/DFmissing_map', 'lib/DFcenters', 'lib/DFcountries',
+    'lib/DFdomain_map']
+
+def configDigest(studydir, domains, settings):
+    '''Hash the study configuration, backgrounds and closeout settings'''
+    digest = hashlib.sha1(datafax.__version__)
+    paths = [os.path.join(studydir, name) for name in STUDY_FILES]
+    if domains is not None:
+        paths.append(domains)
+    for path in paths:
+        try:
+            with open(path, 'rb') as f:
+                digest.update(hashlib.sha1(f.read()).digest())
+        except IOError:
+            digest.update(path)
+
+    bkgd_dir = os.path.join(studydir, 'bkgd')
+    try:
+        names = sorted(os.listdir(bkgd_dir))
+    except OSError:
+        names = []
+    for name in names:
+        st = os.stat(os.path.join(bkgd_dir, name))
+        digest.update(repr((name, st.st_mtime, st.st_size)))
+
+    digest.update(repr(settings))
+    return digest.hexdigest()
+
+def hashRows(digest, rows):
+    for row in rows:
+        digest.update(repr(tuple([str(v) if isinstance(v, buffer) else v
+            for v in row])))
+
+def readManifest(path):
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+def writeManifest(path, manifest):
+    with open(path + '.tmp', 'w') as f:
+        json.dump(manifest, f)
+    os.rename(path + '.tmp', path)
+
+############################################################################
+# rasterPaths - The paths an attached raster may be found at, in order
+############################################################################
+def rasterPaths(shadow_pages, studydir, raster):
+    paths = []
+    if shadow_pages:
+        paths.append(os.path.join(shadow_pages, raster))
+    paths.append(os.path.join(studydir, 'pages', raster))
+    return paths
+
+# The renderer of a --jobs worker process
+worker_renderer = None
+
+def initWorker(renderer):
+    global worker_renderer
+    worker_renderer = renderer
+
+def renderInWorker(task):
+    '''Render a patient in a worker process. Returns the console output
+    and the return code, for the parent to print in patient order.'''
+    (db, pid, center_number, rec_select, ordered, include_secondaries,
+        audit_txn) = task
+    output = StringIO()
+    stdout = sys.stdout
+    sys.stdout = output
+    try:
+        code = worker_renderer.render(worker_renderer.connection(db), pid,
+                center_number, rec_select, ordered, include_secondaries,
+                audit_txn)
+    finally:
+        sys.stdout = stdout
+    return (output.getvalue(), code)
+
 ############################################################################
 # MAIN
 ############################################################################
@@ -1378,6 +2477,8 @@ def main():
     include_chronological_audit = True
     include_field_audit = True
     db = 'data.db'
+    catalog = None
+    shards = None
     domains = None
     redaction = None
     redaction_dict = {}
@@ -1394,8 +2495,21 @@ def main():
     studydir = None
     format_pid = None
     pid_list_only = False
+    follow = False
+    poll_interval = 30
     fontsize = 10
     leading = 12
+    jobs = 1
+    volume_pages = 0
+    volume_bytes = 0
+    image_dpi = 0
+    image_format = None
+    image_quality = 75
+    image_grayscale = False
+    image_cache = None
+    incremental = False
+    estimate = False
+    serve_address = None
 
     try:
         opts, args = getopt.getopt(sys.argv[1:], 'bd:s:I:P:V:L:D:',
@@ -1405,7 +2519,11 @@ def main():
                  'exclude-field-audit', 'pid-list-only',
                  'prefer-background=', 'shadow-pages=', 'redaction=',
                  'format-pid=', 'fontsize=', 'leading=', 'include-secondaries',
-                 'include-deleted', 'version'])
+                 'include-deleted', 'follow', 'poll-interval=', 'catalog=',
+                 'shard=', 'jobs=', 'volume-pages=', 'volume-bytes=',
+                 'image-dpi=', 'image-format=', 'image-quality=',
+                 'image-grayscale', 'image-cache=', 'incremental', 'estimate',
+                 'serve=', 'version'])
     except getopt.GetoptError, err:
         print(err)
         sys.exit(2)
@@ -1459,6 +2577,39 @@ def main():
             include_secondaries = True
         if o == '--include-deleted':
             include_deleted = True
+        if o == '--follow':
+            follow = True
+        if o == '--poll-interval':
+            poll_interval = int(a)
+        if o == '--catalog':
+            catalog = a
+        if o == '--shard':
+            shards = a.split(',')
+        if o == '--jobs':
+            jobs = int(a)
+        if o == '--volume-pages':
+            volume_pages = int(a)
+        if o == '--volume-bytes':
+            volume_bytes = int(a)
+        if o == '--image-dpi':
+            image_dpi = int(a)
+        if o == '--image-format':
+            if a not in ('jpeg', 'flate'):
+                print('--image-format must be jpeg or flate')
+                sys.exit(2)
+            image_format = a
+        if o == '--image-quality':
+            image_quality = int(a)
+        if o == '--image-grayscale':
+            image_grayscale = True
+        if o == '--image-cache':
+            image_cache = a
+        if o == '--incremental':
+            incremental = True
+        if o == '--estimate':
+            estimate = True
+        if o == '--serve':
+            serve_address = a
         if o == '--version':
             print(datafax.__version__)
             sys.exit(0)
@@ -1468,6 +2619,23 @@ def main():
         print('No --studydir specified')
         sys.exit(2)
 
+    # The service returns a single PDF for a patient
+    if serve_address and (volume_pages or volume_bytes):
+        print('--serve cannot be used with --volume-pages or --volume-bytes')
+        sys.exit(2)
+
+    # --serve workers render in a directory of their own, so the paths
+    # given are made absolute first
+    studydir = os.path.abspath(studydir)
+    if shadow_pages:
+        shadow_pages = os.path.abspath(shadow_pages)
+    if image_cache:
+        image_cache = os.path.abspath(image_cache)
+    if db:
+        db = os.path.abspath(db)
+    if catalog:
+        catalog = os.path.abspath(catalog)
+
     study = datafax.Study()
     study.loadFromFiles(studydir)
     if domains is not None:
@@ -1480,124 +2648,127 @@ def main():
 
     centerdb = study.Centers()
 
-    sql = sqlite3.connect(db)
-    if include_secondaries:
-        cursor = sql.execute('select name from sqlite_master where type=\'table\' and name=\'secondaries\'')
-        if len(cursor.fetchall()) == 0:
-            print('WARNING: --include-secondaries specified, but intermediate database does not')
-            print('         contain any secondary image data')
-            include_secondaries = False
-
-    if include_deleted:
-        cursor = sql.execute('select name from sqlite_master where type=\'table\' and name=\'deleted\'')
-        if len(cursor.fetchall()) == 0:
-            print('WARNING: --include-deleted specified, but intermediate database does not')
-            print('         contain any deleted record data')
-            include_deleted = False
-
-    clauses = []
-    pid_clause = patients.toSQL('pid')
-    if pid_clause:
-        clauses.append(pid_clause)
-    visit_clause = visits.toSQL('visit')
-    if visit_clause:
-        clauses.append(visit_clause)
-    plate_clause = plates.toSQL('plate')
-    if plate_clause:
-        clauses.append(plate_clause)
-    level_clause = levels.toSQL('level')
-    if level_clause:
-        clauses.append(level_clause)
-
-    if clauses:
-        where_clause = 'where ' + ' and '.join(clauses)
+    # Converted images go in --image-cache, or a directory for this run
+    images = ImageProcessor(image_dpi, image_format, image_quality,
+            image_grayscale, image_cache)
+    if images.enabled and image_cache is None:
+        images.cache_dir = tempfile.mkdtemp(prefix='closeout')
+        atexit.register(shutil.rmtree, images.cache_dir, True)
+    elif images.enabled and not os.path.isdir(image_cache):
+        os.makedirs(image_cache)
+
+    renderer = PatientRenderer(study, blinded, redaction_dict,
+            include_attached_images, prefer_background, shadow_pages,
+            format_pid, include_chronological_audit, include_field_audit,
+            fontsize, leading, quiet, volume_pages, volume_bytes, images,
+            incremental, configDigest(studydir, domains, [blinded,
+                sorted(redaction_dict.keys()), include_attached_images.toString(),
+                prefer_background, shadow_pages, format_pid,
+                include_chronological_audit, include_field_audit, fontsize,
+                leading, volume_pages, volume_bytes, images.settings,
+                images.enabled]))
+
+    # Render patients in worker processes, forked after the study is
+    # loaded so they share it
+    pool = None
+    pending = deque()
+    if jobs > 1 and not pid_list_only and not estimate and not serve_address:
+        pool = multiprocessing.Pool(jobs, initWorker, (renderer,))
+
+    # A sharded build has one database per site or patient bucket
+    if catalog:
+        dbs = closeoutdb.shardPaths(catalog, shards, patients.toSQL('pid'),
+                centers)
     else:
-        where_clause = ''
-
-    # Get a list of unique patient IDs that match criteria
-    pid_cursor = sql.execute('''
-        select distinct pid
-        from data ''' + where_clause + ''' order by pid''')
-
-    # Build Select statement for fetching records
-    clauses = ['pid=:pid']
-    if plate_clause:
-        clauses.append(plate_clause)
-    if visit_clause:
-        clauses.append(visit_clause)
-    if level_clause:
-        clauses.append(level_clause)
-    rec_select = '''
-        select pid, visit, plate, data
-        from data
-        where ''' + ' and '.join(clauses)
-    if include_deleted:
-        rec_select = rec_select + '''
-            union select pid, visit, plate, data
-            from deleted
-            where ''' + ' and '.join(clauses)
-
-    # Now loop through each patient and generate output pages for them
-    for pid in pid_cursor:
-        center_number = centerdb.centerNumber(pid[0])
-        if centers and not centers.contains(center_number):
-            continue
-        if pid_list_only:
-            print(pid[0])
-            continue
-
-        print('Site {0} Patient {1}'.format(center_number, pid[0]))
-        try:
-            os.mkdir('{0}'.format(center_number))
-        except OSError:
-            pass
-
-        pdf = DFpdf(str(center_number), formatPID(format_pid, pid[0]),
-                sql, study, blinded, redaction_dict,
-            include_attached_images, prefer_background, shadow_pages, format_pid,
-            include_chronological_audit, include_field_audit, fontsize,
-            leading, include_secondaries)
-
-        rec_cursor = sql.execute(rec_select, {'pid': pid[0]})
-        dataRecs = rec_cursor.fetchall()
-        visitmap = study.visitMap()
-        sortedRecs=[]
-
-        # For each record, get its plate display order
-        for (pid_num, visit_num, plate_num, datarec) in dataRecs:
-            visitentry = visitmap.entry(visit_num)
-            if visitentry is None:
-                plateorder = 0
-            else:
-                plateorder = visitentry.plateOrder(plate_num)
+        dbs = [db]
 
-            sortedRecs.append((pid_num, visit_num, plate_num, plateorder, datarec))
-
-        # Sort by visit, plate display order
-        sortedRecs.sort(key=lambda x: (x[1], x[3], x[2])) # Visit, order, plate
+    # --estimate writes a CSV line for each patient and then each site
+    if estimate:
+        report = csv.writer(sys.stdout)
+        report.writerow(['type', 'site', 'patient', 'records', 'pages',
+            'attachments', 'attachment_bytes', 'audit_rows'])
+        site_totals = {}
 
-        pdf.generateBookmarksForPatient(sortedRecs)
+    # Records are selected by visit, plate and level
+    pid_clause = patients.toSQL('pid')
+    record_clauses = []
+    for clause in [visits.toSQL('visit'), plates.toSQL('plate'),
+            levels.toSQL('level')]:
+        if clause:
+            record_clauses.append(clause)
+
+    if serve_address:
+        serve(serve_address, RenderService(renderer, centerdb, centers, dbs,
+            catalog, shards, record_clauses, include_secondaries,
+            include_deleted, jobs))
+        sys.exit(0)
+
+    for db in dbs:
+        sql = sqlite3.connect(db)
+        # Settings for this database only, as each shard may differ
+        (secondaries, deleted, audit_txn, ordered, following) = \
+                databaseSettings(db, sql, studydir, include_secondaries,
+                include_deleted, follow)
+
+        clauses = []
+        if pid_clause:
+            clauses.append(pid_clause)
+        clauses.extend(record_clauses)
+
+        # Get a list of unique patient IDs that match criteria
+        pid_cursor = patientIDs(sql, clauses, following, poll_interval)
+
+        # Build Select statement for fetching records
+        rec_select = closeoutdb.recordSelect(record_clauses, deleted,
+                ordered)
+
+        # Now loop through each patient and generate output pages for them
+        for pid in pid_cursor:
+            center_number = centerdb.centerNumber(pid[0])
+            if centers and not centers.contains(center_number):
+                continue
+            if pid_list_only:
+                print(pid[0])
+                continue
+            if estimate:
+                sizes = renderer.estimate(sql, pid[0], record_clauses,
+                        deleted, secondaries)
+                report.writerow(['patient', center_number, pid[0]] +
+                        list(sizes))
+                totals = site_totals.setdefault(center_number,
+                        [0]*len(sizes))
+                for i, size in enumerate(sizes):
+                    totals[i] += size
+                continue
 
-        # Now traverse sorted list and output records
-        for (pid_num, visit_num, plate_num, plateorder, datarec) in sortedRecs:
-            if not quiet:
-                print("  ", pid_num, visit_num, plate_num)
-            pdf.outputPatientRecord(pid_num, visit_num, plate_num, datarec)
+            if pool is None:
+                retcode = max(retcode, renderer.render(sql, pid[0],
+                    center_number, rec_select, ordered, secondaries,
+                    audit_txn))
+                continue
 
-        # Actually build the PDF file based on the content generated above
-        print('Writing out PDF file...')
-        try:
-            pdf.close(quiet)
-        except LayoutError as e:
-            print('****** ERROR: Unable to layout page for',
-                    pdf.headerId, 'Visit', pdf.headerVisitNum,
-                    '({0})'.format(pdf.headerVisitLabel),
-                    'Plate', pdf.headerPlateNum,
-                    '({0})'.format(pdf.headerPlateLabel))
-            if not quiet:
-                print('    ',e)
-            print('****** Try using a smaller font using --font-size and --leading options')
-            retcode = 1
+            # Print each patient's output once it and all the patients
+            # before it are done, keeping a few patients queued per worker
+            pending.append(pool.apply_async(renderInWorker, ((db, pid[0],
+                center_number, rec_select, ordered, secondaries,
+                audit_txn),)))
+            while len(pending) > jobs*2 or (pending and pending[0].ready()):
+                (output, code) = pending.popleft().get()
+                sys.stdout.write(output)
+                retcode = max(retcode, code)
+
+    while pending:
+        (output, code) = pending.popleft().get()
+        sys.stdout.write(output)
+        retcode = max(retcode, code)
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    if estimate:
+        for center_number in sorted(site_totals):
+            report.writerow(['site', center_number, ''] +
+                    site_totals[center_number])
 
     sys.exit(retcode)
 
@@ -0,0 +1,141 @@
+#!/opt/datafax/PHRI/python27
+#
+# Copyright 2019, Population Health Research Institute
+# Copyright 2019, Martin Renters
+#
+# This file is part of the DataFax Toolkit.
+#
+# The DataFax Toolkit is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# The DataFax Toolkit is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with The DataFax Toolkit.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+#####################################################################
+# Fetch patient PDFs from a closeout --serve service
+#
+#   closeout_client.py --serve=/tmp/closeout.sock --output=pdfs 1001 1002
+#####################################################################
+
+from __future__ import print_function
+
+import getopt
+import httplib
+import os
+import socket
+import sys
+import threading
+import time
+
+class UnixHTTPConnection(httplib.HTTPConnection):
+    '''An HTTP connection over a Unix socket'''
+    def __init__(self, socket_path, timeout):
+        httplib.HTTPConnection.__init__(self, 'localhost', timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+def connect(address, timeout):
+    '''Connect to a port, host:port or Unix socket path as for --serve'''
+    if '/' in address:
+        return UnixHTTPConnection(address, timeout)
+    (host, sep, port) = address.rpartition(':')
+    return httplib.HTTPConnection(host or '127.0.0.1', int(port),
+            timeout=timeout)
+
+def fetch(address, pid, output, timeout):
+    '''Fetch a patient's PDF into output. Returns a line describing the
+    outcome and whether it succeeded.'''
+    start = time.time()
+    try:
+        conn = connect(address, timeout)
+        conn.request('GET', '/patients/{0}'.format(pid))
+        response = conn.getresponse()
+        body = response.read()
+        conn.close()
+    except (socket.error, httplib.HTTPException), err:
+        return ('{0}: {1}'.format(pid, err), False)
+    elapsed = time.time() - start
+
+    if response.status != 200:
+        return ('{0}: {1} {2}\n{3}'.format(pid, response.status,
+            response.reason, body.rstrip()), False)
+    path = os.path.join(output, '{0}.pdf'.format(pid))
+    with open(path, 'wb') as f:
+        f.write(body)
+    return ('{0}: {1} bytes in {2:.2f}s'.format(pid, len(body), elapsed),
+            True)
+
+def main():
+    address = None
+    output = '.'
+    parallel = 1
+    timeout = 600
+
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'o:',
+            ['serve=', 'output=', 'parallel=', 'timeout='])
+    except getopt.GetoptError, err:
+        print(err)
+        sys.exit(2)
+
+    for o, a in opts:
+        if o == '--serve':
+            address = a
+        if o in ('-o', '--output'):
+            output = a
+        if o == '--parallel':
+            parallel = int(a)
+        if o == '--timeout':
+            timeout = int(a)
+
+    if not address:
+        print('No --serve address specified')
+        sys.exit(2)
+    if not args:
+        print('No patient IDs specified')
+        sys.exit(2)
+    if not os.path.isdir(output):
+        os.makedirs(output)
+
+    # Up to --parallel requests at a time
+    pids = list(args)
+    results = {}
+    lock = threading.Lock()
+    def worker():
+        while True:
+            with lock:
+                if not pids:
+                    return
+                pid = pids.pop(0)
+            results[pid] = fetch(address, pid, output, timeout)
+
+    start = time.time()
+    threads = [threading.Thread(target=worker) for i in range(parallel)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    retcode = 0
+    for pid in args:
+        (line, ok) = results[pid]
+        print(line)
+        if not ok:
+            retcode = 1
+    print('{0} patients in {1:.2f}s'.format(len(args), time.time() - start))
+    sys.exit(retcode)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,247 @@
+#
+# Copyright 2019, Population Health Research Institute
+# Copyright 2019, Martin Renters
+#
+# This file is part of the DataFax Toolkit.
+#
+# The DataFax Toolkit is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# The DataFax Toolkit is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with The DataFax Toolkit.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+from collections import namedtuple
+import time
+from datafax import closeoutdb
+
+LOST_CODES = {
+        '1': 'Patient Missed Visit',
+        '2': 'Exam or Test Not Performed',
+        '3': 'Data Not Available',
+        '4': 'Patient Refused',
+        '5': 'Patient Moved Away',
+        '6': 'Patient Lost to Follow-up',
+        '7': 'Patient Died',
+        '8': 'Patient Terminated due to Study Illness',
+        '9': 'Patient Terminated due to Other Illness',
+        '10': 'Other Reason'
+}
+
+# A row of closeoutdb.AUDIT_SELECT
+AuditRow = namedtuple('AuditRow', '''who, tstamp, status, op, type, funiqueid,
+    fnum, metafnum, code, reason, desc, oldval, newval, oldvaldec, newvaldec''')
+
+# An audit record with its transaction's date and time
+AuditRec = namedtuple('AuditRec', '''who, tdate, ttime, status, op, type,
+    funiqueid, fnum, metafnum, code, reason, desc, oldval, newval, oldvaldec,
+    newvaldec''')
+
+# The changes one user made to one field at one time, as paragraph markup
+AuditTxn = namedtuple('AuditTxn', '''who, tdate, ttime, funiqueid, fnum, desc,
+    ops''')
+
+def escapeString(s):
+    '''Escape characters that are special in paragraph markup'''
+    s=s.replace('&', '&amp;')
+    s=s.replace('<', '&lt;')
+    s=s.replace('>', '&gt;')
+    return s
+
+#############################################################################
+# AuditTrail - Convert a record's audit trail to human readable transactions
+#############################################################################
+class AuditTrail(object):
+    def __init__(self, study):
+        self.study = study
+
+    ###########################################################################
+    # transactions - Group the rows of closeoutdb.AUDIT_SELECT for a record
+    # into a list of AuditTxn. Internal and redacted fields are included;
+    # it is up to the caller to leave them out.
+    ###########################################################################
+    def transactions(self, rows):
+        auditRecs = map(AuditRow._make, rows)
+
+        # Group audit records into data/reason/qc transactions. Sometimes
+        # data/reason/qc records have slightly different timestamps because
+        # of how the server writes them out.
+        groupedAuditRecs = []
+        last = None
+        lastTime = 0
+        for rec in auditRecs:
+            thisTime = rec.tstamp
+            if last is None or last.who != rec.who or \
+                    lastTime//86400 != thisTime//86400 \
+                    or (lastTime != thisTime and lastTime != (thisTime-1)):
+                    last = rec
+                    lastTime = thisTime
+                    t = time.gmtime(thisTime)
+                    tdate = '{0:04d}/{1:02d}/{2:02d}'.format(t[0], t[1], t[2])
+                    ttime = '{0:02d}:{1:02d}:{2:02d}'.format(t[3], t[4], t[5])
+
+            funiqueid = rec.funiqueid
+
+            if rec.fnum is None or rec.fnum == '':
+                fnum = 0
+            else:
+                fnum = int(rec.fnum)
+
+            # For deleted records, get reason from DFPLATE and mark
+            # it for all fields (funique=0 and fnum=0)
+            if rec.type == 'r' and rec.funiqueid <5100 and rec.metafnum == 0:
+                funiqueid = 0
+                fnum = 0
+
+            groupedAuditRecs.append(AuditRec(rec.who, tdate, ttime, \
+                    rec.status, rec.op, rec.type, funiqueid, fnum, \
+                    rec.metafnum, rec.code, rec.reason, rec.desc, \
+                    closeoutdb.unpack(rec.oldval), \
+                    closeoutdb.unpack(rec.newval), rec.oldvaldec, \
+                    rec.newvaldec))
+
+        auditRecs = sorted(groupedAuditRecs, key=lambda x: \
+                (x.tdate, x.ttime, abs(x.fnum), x.type, x.metafnum))
+
+        # Now group operations by fields
+        auditOps = []
+        last = None
+        # Process each audit record and group them into transactions
+        for rec in auditRecs:
+            if last is None or last.who != rec.who or last.tdate != rec.tdate or \
+                    last.ttime != rec.ttime or last.funiqueid != rec.funiqueid:
+                if last is not None and ops:
+                    auditOps.append(AuditTxn(last.who, last.tdate, last.ttime, \
+                            last.funiqueid, last.fnum, desc, ops))
+                last = rec
+                desc = escapeString(last.desc)
+                ops = []
+
+            # Skip system fields
+            if rec.funiqueid >0 and rec.funiqueid < 10000:
+                continue
+
+            if rec.type == 'd':
+                self.dataOps(rec, ops)
+            elif rec.type == 'q':
+                self.qcOps(rec, ops)
+            elif rec.type == 'r':
+                self.reasonOps(rec, ops)
+
+        # Add last transaction to list
+        if last is not None and ops:
+            auditOps.append(AuditTxn(last.who, last.tdate, last.ttime, \
+                last.funiqueid, last.fnum, desc, ops))
+
+        return auditOps
+
+    ###############################################################
+    # DATA RECORDS
+    ###############################################################
+    def dataOps(self, rec, ops):
+        missingLabel = self.study.missingValueLabel(rec.oldval)
+        if missingLabel is not None:
+            oldval = '[' + rec.oldval + ', ' + missingLabel + ']'
+        else:
+            if rec.oldval != '' and rec.oldvaldec != '':
+                oldval = rec.oldval + ', ' + rec.oldvaldec
+            else:
+                oldval = rec.oldval
+
+            if oldval == "":
+                oldval = '[blank]'
+
+        missingLabel = self.study.missingValueLabel(rec.newval)
+        if missingLabel is not None:
+            newval = '[' + rec.newval + ', ' + missingLabel + ']'
+        else:
+            if rec.newval != '' and rec.newvaldec != '':
+                newval = rec.newval + ', ' + rec.newvaldec
+            else:
+                newval = rec.newval
+
+            if newval == "":
+                newval = '[blank]'
+
+        if rec.op == 'N':
+            if rec.status == 0:
+                reason = LOST_CODES.get(rec.code, 'Other')
+                if rec.reason:
+                    reason = reason + ' [' + rec.reason + ']'
+                ops.append('Data Record marked Lost: {0}'.format(reason))
+            else:
+                newval = escapeString(newval)
+                ops.append('Initial Value: <b>{0}</b>'.format(newval))
+        elif rec.op == 'C':
+            oldval = escapeString(oldval)
+            newval = escapeString(newval)
+            if len(oldval) > 100 or len(newval) > 100:
+                ops.append('Changed Value: <b>{0}</b>'.format(newval))
+            else:
+                ops.append('Changed Value: <b>{0} \u2192 {1}</b>'.format(oldval, newval))
+        elif rec.op == 'D':
+            ops.append('Data Record Deleted')
+
+    ###############################################################
+    # QC RECORDS
+    ###############################################################
+    def qcOps(self, rec, ops):
+        if rec.metafnum not in [0,1,12,17,18]:
+            return
+        qctype = self.study.qcType(rec.code)
+        qcstatus = self.study.qcStatus(rec.status, False)
+        label = ''
+        value = escapeString(rec.newval)
+        if rec.metafnum == 1:
+            label = "Status"
+            value = qcstatus
+            if rec.status in [2, 6]:
+                return
+        elif rec.metafnum == 12:
+            label = "Reply"
+            if rec.op == 'N' and not rec.newval:
+                return
+        elif rec.metafnum == 17:
+            label = "Query"
+        elif rec.metafnum == 18:
+            if rec.op == 'N' and not rec.newval:
+                return
+            label = "Note"
+        if rec.op == 'N' or rec.op == 'C':
+            ops.append('QC {0} ({1}): <i>{2}</i>'.format(label, qctype, \
+                    value))
+        elif rec.op == 'D':
+            ops.append('QC Deleted ({0})'.format(qctype))
+
+    ###############################################################
+    # REASON RECORDS
+    ###############################################################
+    def reasonOps(self, rec, ops):
+        if rec.metafnum not in [0, 1, 10]:
+            return
+        if rec.op == 'N' or rec.op == 'C':
+            s = self.study.reasonStatus(rec.status)
+            if rec.metafnum == 0:
+                ops.append('<i>{0}</i>'.format(rec.reason))
+            if rec.metafnum == 1:
+                ops.append('Reason Status: <i>{0}</i>'.format(s))
+            if rec.metafnum == 10:
+                newval = escapeString(rec.newval)
+                ops.append('Reason Text: <i>{0}</i>'.format(newval))
+        elif rec.op == 'D':
+            if rec.metafnum == 0 and rec.funiqueid < 5100:
+                ops.append('<i>{0}</i>'.format(rec.reason))
+            else:
+                ops.append('Reason Deleted')
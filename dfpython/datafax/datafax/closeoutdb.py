@@ -0,0 +1,513 @@
+#
+# Copyright 2019, Population Health Research Institute
+# Copyright 2019, Martin Renters
+#
+# This file is part of the DataFax Toolkit.
+#
+# The DataFax Toolkit is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# The DataFax Toolkit is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with The DataFax Toolkit.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import hashlib
+import os
+import sqlite3
+import zlib
+
+#############################################################################
+# Queries run by closeout against the database built by make_closeout_db.
+# They live here so the database builder can verify that its indexes
+# serve every one of them.
+#############################################################################
+AUDIT_COLUMNS = '''
+        who_strings.string, a.tstamp, a.status, a.op, a.type, a.funiqueid,
+        a.fnum, a.metafnum, code_strings.string, reason_strings.string,
+        shared_strings.string, a.oldval, a.newval, old_strings.string,
+        new_strings.string
+    from audit a
+    join who_strings on a.whoid = who_strings.id
+    join code_strings on a.codeid = code_strings.id
+    join reason_strings on a.reasonid = reason_strings.id
+    join shared_strings on a.fdescid = shared_strings.id
+    join valdec_strings old_strings on a.oldvaldecid = old_strings.id
+    join valdec_strings new_strings on a.newvaldecid = new_strings.id'''
+
+AUDIT_SELECT = '''
+    select''' + AUDIT_COLUMNS + '''
+    where a.pid=? and a.visit=? and a.plate=?
+    order by a.tstamp'''
+
+# A patient's whole audit trail, pre-grouped transactions and secondaries in
+# one query each, in (visit, plate) order for closeout to partition by record
+PATIENT_AUDIT_SELECT = '''
+    select a.visit, a.plate,''' + AUDIT_COLUMNS + '''
+    where a.pid=?
+    order by a.visit, a.plate, a.tstamp'''
+
+PATIENT_AUDIT_TXN_SELECT = '''
+    select visit, plate, who, tdate, ttime, funiqueid, fnum, desc, ops
+    from audit_txn
+    where pid=?
+    order by visit, plate, seq'''
+
+PATIENT_SECONDARIES_SELECT = '''
+    select visit, plate, raster from secondaries
+    where pid=?
+    order by visit, plate, raster'''
+
+# The number of audit rows for each of a patient's records
+PATIENT_AUDIT_COUNTS = '''
+    select visit, plate, count(*) from audit
+    where pid=?
+    group by visit, plate'''
+
+# Records having a value in a field, from make_closeout_db --field-values.
+# Nothing in the toolkit reads the table yet; this is the lookup it is
+# indexed for, for queries against the database.
+FIELD_VALUE_SELECT = '''
+    select pid, visit from field_values
+    where plate=? and field=? and value=?
+    order by pid, visit'''
+
+#############################################################################
+# make_closeout_db --compress stores long data records and audit values as
+# zlib compressed blobs. Short values, and ones that do not compress, stay
+# as text, so readers must pass these columns through unpack().
+#############################################################################
+COMPRESS_MIN = 64
+
+def pack(text):
+    '''Returns the value to store for text in a compressed column'''
+    if len(text) < COMPRESS_MIN:
+        return text
+    data = zlib.compress(text.encode('utf-8'))
+    if len(data) >= len(text):
+        return text
+    return sqlite3.Binary(data)
+
+def unpack(value):
+    '''Returns the text of a compressed column value'''
+    if isinstance(value, buffer):
+        return zlib.decompress(value).decode('utf-8')
+    return value
+
+def patientSelect(clauses):
+    '''Select the distinct patient IDs having records matching clauses'''
+    if clauses:
+        where_clause = 'where ' + ' and '.join(clauses)
+    else:
+        where_clause = ''
+
+    return '''
+        select distinct pid
+        from data ''' + where_clause + ''' order by pid'''
+
+def readyPatientSelect(clauses):
+    '''Select the patient IDs after :last that have been completely loaded
+    and have records matching clauses'''
+    clauses = ['pid in (select pid from patients_ready)', 'pid>:last'] + \
+        clauses
+    return patientSelect(clauses)
+
+def recordSelect(clauses, include_deleted, ordered):
+    '''Select the records for patient :pid that match clauses, with their
+    display order if the database has one (ordered), or null'''
+    clauses = ['pid=:pid'] + clauses
+    if ordered:
+        columns = 'pid, visit, plate, data, display_order'
+    else:
+        columns = 'pid, visit, plate, data, null'
+    select = '''
+        select ''' + columns + '''
+        from data
+        where ''' + ' and '.join(clauses)
+    # Deleted records only exist where there is no data record, so
+    # there are no duplicates to remove
+    if include_deleted:
+        select = select + '''
+            union all select ''' + columns + '''
+            from deleted
+            where ''' + ' and '.join(clauses)
+    if ordered:
+        select = select + ' order by 5'
+    return select
+
+def recordCountSelect(clauses, include_deleted):
+    '''Select the number of records for patient :pid that match clauses,
+    by visit and plate, without reading the records themselves'''
+    clauses = ['pid=:pid'] + clauses
+    select = '''
+        select visit, plate, count(*)
+        from data
+        where ''' + ' and '.join(clauses) + '''
+        group by visit, plate'''
+    if include_deleted:
+        select = select + '''
+            union all select visit, plate, count(*)
+            from deleted
+            where ''' + ' and '.join(clauses) + '''
+            group by visit, plate'''
+    return select
+
+def recordRasterSelect(clauses, include_deleted):
+    '''Select the visit, plate and raster of the records for patient :pid
+    that match clauses. Records stored compressed are selected whole, and
+    the raster is sliced from them after unpack().'''
+    clauses = ['pid=:pid'] + clauses
+    columns = '''visit, plate, case when typeof(data)='text'
+            then substr(data, 5, 12) else data end'''
+    select = '''
+        select ''' + columns + '''
+        from data
+        where ''' + ' and '.join(clauses)
+    if include_deleted:
+        select = select + '''
+            union all select ''' + columns + '''
+            from deleted
+            where ''' + ' and '.join(clauses)
+    return select
+
+def displayOrder(visitmap, visit, plate):
+    '''Returns the position of a record in closeout's output for a
+    patient: by visit, then the visit map's plate order, then plate'''
+    visitentry = visitmap.entry(visit)
+    if visitentry is None:
+        plateorder = 0
+    else:
+        plateorder = visitentry.plateOrder(plate)
+    return visit*1000000 + plateorder*1000 + plate
+
+def buildInfo(sql):
+    '''Returns the build_info settings of a database, or an empty dict for
+    one built before they were recorded'''
+    try:
+        return dict(sql.execute('select name, value from build_info'))
+    except sqlite3.OperationalError:
+        return {}
+
+# The study setup files whose contents the text of grouped audit
+# transactions depends on
+AUDIT_TXN_SETUP_FILES = ['lib/DFsetup', 'lib/DFmissing_map']
+
+def setupDigest(studydir):
+    '''Returns a digest of the study setup audit transactions are grouped
+    with, recorded in build_info as audit_txn_setup'''
+    digest = hashlib.sha1()
+    for name in AUDIT_TXN_SETUP_FILES:
+        try:
+            with open(os.path.join(studydir, name), 'rb') as f:
+                digest.update(hashlib.sha1(f.read()).digest())
+        except IOError:
+            digest.update(name.encode('utf-8'))
+    return digest.hexdigest()
+
+def buildComplete(sql):
+    '''Returns whether make_closeout_db has finished building the database'''
+    cursor = sql.execute(
+        "select value from build_info where name='complete'")
+    return cursor.fetchone() is not None
+
+def shardPaths(catalog, names, pid_clause, centers):
+    '''Returns the paths of the shards listed in a catalog built by
+    make_closeout_db --shard-by that are named in names (all if None),
+    hold patients matching pid_clause and, for site shards, belong to one
+    of the centers RangeList (all if None)'''
+    catalog_sql = sqlite3.connect(catalog)
+    query = '''select name, path, site from shards where name in
+        (select shard from patients'''
+    if pid_clause:
+        query = query + ' where ' + pid_clause
+    rows = catalog_sql.execute(query + ') order by name').fetchall()
+    catalog_sql.close()
+
+    paths = []
+    for (name, path, site) in rows:
+        if names is not None and name not in names:
+            continue
+        if centers and site is not None and not centers.contains(site):
+            continue
+        paths.append(os.path.join(os.path.dirname(catalog), path))
+    return paths
+
+#############################################################################
+# Schema versions. make_closeout_db records the version of the layout it
+# built in build_info, and migrate() brings a database built by an older
+# version up to date in place, so that new indexes and encodings do not
+# need a full rebuild from DataFax.
+#
+#   0   not recorded: built before versions were recorded, possibly with
+#       the original plain text audit columns
+#   1   dictionary encoded audit columns with times in seconds, covering
+#       indexes, checkpoints, build_info and patients_ready
+#   2   audit_keys on the columns audit rows are selected and sorted by
+#       only, rather than covering the whole audit table
+#############################################################################
+SCHEMA_VERSION = 2
+
+# Tables and columns every database of the current version holds
+SCHEMA_FEATURES = ['deleted', 'secondaries', 'patients_ready', 'build_info',
+    'audit.tstamp']
+
+# Tables and columns a database only holds if make_closeout_db was run with
+# the option recorded under the build_info name
+OPTIONAL_FEATURES = {
+    'audit_txn': 'audit_txn',
+    'field_values': 'field_values',
+    'data.display_order': 'display_order',
+}
+
+#############################################################################
+# Schema - The version and optional tables and columns of a database. A
+# database built before versions were recorded is looked over instead.
+#############################################################################
+class Schema(object):
+    def __init__(self, sql):
+        self.info = buildInfo(sql)
+        self.version = int(self.info.get('schema_version', 0))
+        self.probed = None
+        if self.version == 0:
+            self.probed = set([r[0] for r in sql.execute(
+                "select name from sqlite_master where type='table'")])
+            for table in ('data', 'audit'):
+                self.probed.update(['{0}.{1}'.format(table, r[1]) for r in \
+                    sql.execute('pragma table_info({0})'.format(table))])
+
+    def has(self, feature):
+        '''Returns whether the database holds feature, a table name or a
+        table.column'''
+        if self.probed is not None:
+            return feature in self.probed
+        if feature in SCHEMA_FEATURES:
+            return True
+        return bool(self.info.get(OPTIONAL_FEATURES.get(feature)))
+
+    def current(self):
+        '''Returns whether closeout can read the database as it is'''
+        if self.version > SCHEMA_VERSION:
+            return False
+        return self.has('audit.tstamp')
+
+#############################################################################
+# Migrations. Each brings a database to its version from any earlier one,
+# including the unrecorded version 0, so each is written to only do what
+# is still missing. The table layouts are spelled out in full because they
+# are those of the migration's version, not necessarily the current one.
+#############################################################################
+def migrateVersion1(sql):
+    audit_columns = [r[1] for r in sql.execute('pragma table_info(audit)')]
+    if 'tstamp' not in audit_columns:
+        # Dictionary encode the repetitive columns, with ids numbered from
+        # 0 like make_closeout_db's
+        encodings = [
+            ('who_strings', 'select distinct coalesce(who, \'\') from audit'),
+            ('code_strings', 'select distinct coalesce(code, \'\') from audit'),
+            ('reason_strings', 'select distinct coalesce(reason, \'\') from audit'),
+            ('valdec_strings', '''select coalesce(oldvaldec, '') from audit
+                union select coalesce(newvaldec, '') from audit'''),
+        ]
+        for (table, select) in encodings:
+            sql.execute('''drop table if exists {0}'''.format(table))
+            sql.execute('''create table {0}
+                (id integer primary key, string text)'''.format(table))
+            sql.executemany('''insert into {0} values(?, ?)'''.format(table),
+                enumerate([r[0] for r in sql.execute(select).fetchall()]))
+            sql.execute('''create index {0}_lookup
+                on {0}(string, id)'''.format(table))
+
+        sql.execute('''drop index if exists audit_keys''')
+        sql.execute('''alter table audit rename to audit_v1''')
+        sql.execute('''create table audit (
+            pid int not null,
+            visit int not null,
+            plate int not null,
+            op text not null,
+            tstamp int not null,
+            whoid int not null,
+            type text not null,
+            status int not null,
+            level int not null,
+            codeid int not null,
+            reasonid int not null,
+            metafnum int not null,
+            funiqueid int not null,
+            fnum int not null,
+            fdescid int not null,
+            oldval text,
+            newval text,
+            oldvaldecid int not null,
+            newvaldecid int not null
+            )''')
+        # Audit times are server local and are kept as-is, as UTC
+        sql.execute('''insert into audit
+            select a.pid, a.visit, a.plate, a.op,
+                cast(strftime('%s', substr(a.tdate, 1, 4) || '-' ||
+                    substr(a.tdate, 5, 2) || '-' || substr(a.tdate, 7, 2) ||
+                    ' ' || substr(a.ttime, 1, 2) || ':' ||
+                    substr(a.ttime, 3, 2) || ':' || substr(a.ttime, 5, 2))
+                    as int),
+                w.id, a.type, a.status, a.level, c.id, r.id, a.metafnum,
+                a.funiqueid, a.fnum, a.fdescid, a.oldval, a.newval, o.id, n.id
+            from audit_v1 a
+            join who_strings w on w.string = coalesce(a.who, '')
+            join code_strings c on c.string = coalesce(a.code, '')
+            join reason_strings r on r.string = coalesce(a.reason, '')
+            join valdec_strings o on o.string = coalesce(a.oldvaldec, '')
+            join valdec_strings n on n.string = coalesce(a.newvaldec, '')
+            order by a.rowid''')
+        sql.execute('''drop table audit_v1''')
+        for table in ('who_strings', 'code_strings', 'reason_strings',
+                'valdec_strings'):
+            sql.execute('''drop index {0}_lookup'''.format(table))
+
+        # Original index on secondaries did not cover the raster
+        sql.execute('''drop index if exists secondary_keys''')
+
+    sql.execute('''create view if not exists audit_view as
+        select a.pid, a.visit, a.plate, a.op,
+            strftime('%Y%m%d', a.tstamp, 'unixepoch') as tdate,
+            strftime('%H%M%S', a.tstamp, 'unixepoch') as ttime,
+            w.string as who, a.type, a.status, a.level,
+            c.string as code, r.string as reason,
+            a.metafnum, a.funiqueid, a.fnum, a.fdescid,
+            a.oldval, a.newval,
+            o.string as oldvaldec, n.string as newvaldec
+        from audit a
+        join who_strings w on a.whoid = w.id
+        join code_strings c on a.codeid = c.id
+        join reason_strings r on a.reasonid = r.id
+        join valdec_strings o on a.oldvaldecid = o.id
+        join valdec_strings n on a.newvaldecid = n.id''')
+
+    sql.execute('''create index if not exists data_keys
+        on data(pid, visit, plate)''')
+    sql.execute('''create index if not exists deleted_keys
+        on deleted(pid, visit, plate)''')
+    sql.execute('''create index if not exists secondary_keys
+        on secondaries(pid, visit, plate, raster)''')
+    sql.execute('''create index if not exists data_pid_level
+        on data(pid, level, visit, plate)''')
+    # audit_keys is left to migrateVersion2, rather than building the
+    # version 1 index over every audit column only to drop it
+
+    sql.execute('''create table if not exists checkpoints (
+        stage text not null,
+        part text not null,
+        primary key (stage, part))''')
+
+    # A database from before build_info was complete if it was usable
+    if not buildInfo(sql):
+        sql.execute('''create table if not exists build_info (
+            name text not null primary key,
+            value text)''')
+        sql.execute('''insert into build_info values('complete', '1')''')
+
+    tables = [r[0] for r in sql.execute(
+        "select name from sqlite_master where type='table'")]
+    if 'patients_ready' not in tables:
+        sql.execute('''create table patients_ready (
+            pid integer primary key)''')
+        sql.execute('''insert into patients_ready
+            select distinct pid from data''')
+
+def migrateVersion2(sql):
+    columns = [r[2] for r in sql.execute('pragma index_info(audit_keys)')]
+    if columns != ['pid', 'visit', 'plate', 'tstamp']:
+        sql.execute('''drop index if exists audit_keys''')
+        sql.execute('''create index audit_keys on audit(pid, visit, plate,
+            tstamp)''')
+        sql.execute('''analyze''')
+
+MIGRATIONS = [
+    (1, migrateVersion1),
+    (2, migrateVersion2),
+]
+
+def migrate(sql):
+    '''Upgrade a database to the current schema version. Returns the
+    versions it was upgraded to, in order.'''
+    version = Schema(sql).version
+    if version > SCHEMA_VERSION:
+        raise ValueError('Database schema version {0} is newer than {1}'.format(
+            version, SCHEMA_VERSION))
+
+    # sqlite3 commits before each DDL statement unless the transaction is
+    # managed here, so run each migration in one explicit transaction. An
+    # interrupted migration then leaves the database as it was, and is
+    # simply run again.
+    isolation_level = sql.isolation_level
+    sql.isolation_level = None
+    upgraded = []
+    try:
+        for (target, migration) in MIGRATIONS:
+            if target <= version:
+                continue
+            sql.execute('''begin''')
+            try:
+                migration(sql)
+                sql.execute('''insert or replace into build_info
+                    values('schema_version', ?)''', (str(target),))
+            except:
+                sql.execute('''rollback''')
+                raise
+            sql.execute('''commit''')
+            upgraded.append(target)
+    finally:
+        sql.isolation_level = isolation_level
+    return upgraded
+
+#############################################################################
+# checkQueryPlans - Use EXPLAIN QUERY PLAN to make sure each closeout query
+# is answered from an index, without scanning a table or sorting in a
+# temporary b-tree. The *_strings dictionaries are small enough that the
+# planner may choose to scan them. Returns a list of (query, plan detail)
+# problems.
+#############################################################################
+def checkQueryPlans(sql):
+    clauses = ['(visit between 0 and 1000)', '(plate=1)', '(level between 1 and 7)']
+    queries = [
+        ('patients', patientSelect([]), ()),
+        ('patients (filtered)', patientSelect(['(pid between 1 and 1000)'] +
+            clauses), ()),
+        ('ready patients', readyPatientSelect(clauses), {'last': 1}),
+        ('records', recordSelect(clauses, True, False), {'pid': 1}),
+        ('audit', AUDIT_SELECT, (1, 1, 1)),
+        ('patient audit', PATIENT_AUDIT_SELECT, (1,)),
+        ('patient secondaries', PATIENT_SECONDARIES_SELECT, (1,)),
+        ('patient audit counts', PATIENT_AUDIT_COUNTS, (1,)),
+    ]
+    schema = Schema(sql)
+    # A patient's records in display order, straight from the index. With
+    # visit, plate or level filters the planner may sort the few records
+    # that match instead.
+    if schema.has('data.display_order'):
+        queries.append(('ordered records', recordSelect([], True, True),
+            {'pid': 1}))
+    if schema.has('audit_txn'):
+        queries.append(('patient audit transactions', PATIENT_AUDIT_TXN_SELECT,
+            (1,)))
+    if schema.has('field_values'):
+        queries.append(('field values', FIELD_VALUE_SELECT, (1, 8, '1')))
+
+    problems = []
+    for (name, query, params) in queries:
+        for row in sql.execute('explain query plan ' + query, params):
+            detail = row[-1]
+            words = detail.replace(' TABLE ', ' ').split()
+            if (words[0] == 'SCAN' and not words[1].endswith('_strings') and
+                    'COVERING INDEX' not in detail) or 'TEMP B-TREE' in detail:
+                problems.append((name, detail))
+    return problems
@@ -0,0 +1,101 @@
+#
+# Copyright 2019, Population Health Research Institute
+# Copyright 2019, Martin Renters
+#
+# This file is part of the DataFax Toolkit.
+#
+# The DataFax Toolkit is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# The DataFax Toolkit is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with The DataFax Toolkit.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+CHUNK_SIZE = 1024*1024
+MIN_WINDOW = 256
+
+#############################################################################
+# decodeLines - Generate the lines of a DataFax byte stream (a pipe from
+# one of the DataFax tools, or a file) as unicode strings without their
+# trailing newline.
+#
+# The stream is read in large chunks and each chunk's complete lines are
+# decoded as UTF-8 at once. Older studies contain Latin-1 text, so if
+# a chunk does not decode, the offending line is decoded as Latin-1 and
+# UTF-8 decoding resumes with the line after it. The lines are slices of
+# the decoded chunk, so there is no per-line decode or newline strip.
+#############################################################################
+def decodeLines(stream, chunk_size=CHUNK_SIZE):
+    rest = b''
+    while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            break
+        if rest:
+            chunk = rest + chunk
+        end = chunk.rfind(b'\n')
+        if end < 0:
+            rest = chunk
+            continue
+        rest = chunk[end+1:]
+        for line in decodeBlock(chunk[:end]):
+            yield line
+
+    # Last line had no newline
+    if rest:
+        for line in decodeBlock(rest):
+            yield line
+
+def decodeBlock(block):
+    '''Decode newline separated lines, Latin-1 only where UTF-8 fails'''
+    # A failed decode copies everything it was given into the exception,
+    # so after a Latin-1 line retry with a smaller window of lines and
+    # grow it again while decoding succeeds. If even the smallest window
+    # fails, the block is mostly Latin-1 and is decoded line by line.
+    pos = 0
+    window = len(block)
+    while pos <= len(block):
+        end = block.find(b'\n', pos + window)
+        if end < 0:
+            end = len(block)
+        try:
+            text = block[pos:end].decode('utf-8')
+        except UnicodeDecodeError, err:
+            if window == MIN_WINDOW:
+                break
+            bad = pos + err.start
+            line_start = block.rfind(b'\n', pos, bad) + 1 or pos
+            line_end = block.find(b'\n', bad, end)
+            if line_end < 0:
+                line_end = end
+            if line_start > pos:
+                for line in block[pos:line_start-1].decode('utf-8').split('\n'):
+                    yield line
+            yield block[line_start:line_end].decode('latin-1')
+            pos = line_end + 1
+            window = max(MIN_WINDOW, window // 4)
+        else:
+            for line in text.split('\n'):
+                yield line
+            pos = end + 1
+            window = window * 2
+    else:
+        return
+
+    for line in block[pos:].split(b'\n'):
+        try:
+            yield line.decode('utf-8')
+        except UnicodeDecodeError:
+            yield line.decode('latin-1')
@@ -23,23 +23,187 @@ from __future__ import unicode_literals
 from __future__ import print_function
 
 import os
+import calendar
 import codecs
+import datetime
 import datafax
+from datafax import closeoutdb
+from datafax import audittrail
+from datafax.streamreader import decodeLines
 import getopt
+import gzip
+import mmap
 import sys
 import sqlite3
 import shlex
 import subprocess
+import time
+import zlib
 
 #####################################################################
-# Decode text as Unicode, and if that doesn't work, try Latin-1
+# SourceError - A source was unable to supply its records
 #####################################################################
-def to_unicode(s):
-    try:
-        u = s.decode('utf-8')
-    except UnicodeDecodeError:
-        u = s.decode('latin-1')
-    return u
+class SourceError(Exception):
+    pass
+
+#####################################################################
+# RPCSource - Read the study from the DataFax server with the
+# DFlistplates.rpc, DFexport.rpc and DFaudittrace tools
+#####################################################################
+class RPCSource(object):
+    def __init__(self, study_num):
+        self.study_num = study_num
+        self.datafax_dir = os.getenv('DATAFAX_DIR', '/opt/datafax')
+
+    def description(self):
+        return 'rpc'
+
+    def run(self, tool, params):
+        '''Generate the lines output by a DataFax tool'''
+        proc = subprocess.Popen([os.path.join(self.datafax_dir, 'bin', tool)] \
+                + params, stdout=subprocess.PIPE)
+        for line in decodeLines(proc.stdout):
+            yield line
+        retcode = proc.wait()
+        if retcode != 0:
+            raise SourceError('{0} failed with exit status {1}'.format(
+                tool, retcode))
+
+    def plates(self):
+        return ' '.join(self.run('DFlistplates.rpc',
+            ['-s', str(self.study_num)])).split()
+
+    def exportPlate(self, plate, patients):
+        params = ['-s', 'lost,primary,secondary']
+        if patients:
+            params.extend(['-I', patients])
+        return self.run('DFexport.rpc', params + [str(self.study_num),
+            plate, '-'])
+
+    def auditPartitions(self):
+        '''DFaudittrace only reads the journals for the dates requested,
+        so split the audit trail into yearly date ranges. This year's
+        ends today.'''
+        today = datetime.date.today()
+        for year in range(1990, today.year):
+            yield '{0}0101-{0}1231'.format(year)
+        yield '{0}0101-{1}'.format(today.year, today.strftime('%Y%m%d'))
+
+    def auditTrace(self, dates, patients):
+        params = ['-s', str(self.study_num)]
+        if patients:
+            params.extend(['-I', patients])
+        return self.run('DFaudittrace', params + ['-d', dates, '-N', '-q',
+            '-r'])
+
+#####################################################################
+# DumpSource - Replay output captured from the DataFax tools, so the
+# database can be built (and ingestion timed) without a server. The
+# directory holds:
+#
+#   plates      output of DFlistplates.rpc -s study
+#   plateNNN    output of DFexport.rpc -s lost,primary,secondary
+#               study NNN -
+#   audit       output of DFaudittrace -s study -d 19900101-today -N -q -r
+#
+# Any of the files may be gzip compressed with a .gz suffix.
+# Uncompressed files can be memory mapped instead of read.
+#####################################################################
+class DumpSource(object):
+    def __init__(self, directory, use_mmap):
+        self.directory = directory
+        self.use_mmap = use_mmap
+
+    def description(self):
+        return 'dump:' + os.path.abspath(self.directory)
+
+    def lines(self, name):
+        '''Generate the lines of a dump file'''
+        path = os.path.join(self.directory, name)
+        if os.path.isfile(path + '.gz'):
+            with gzip.open(path + '.gz', 'rb') as f:
+                for line in decodeLines(f):
+                    yield line
+            return
+
+        if not os.path.isfile(path):
+            raise SourceError('{0} not found'.format(path))
+
+        with open(path, 'rb') as f:
+            if not self.use_mmap or os.fstat(f.fileno()).st_size == 0:
+                for line in decodeLines(f):
+                    yield line
+                return
+
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                for line in decodeLines(mm):
+                    yield line
+            finally:
+                mm.close()
+
+    def matching(self, lines, patients, pid_field):
+        '''Apply a -I patient selection to the lines'''
+        if not patients:
+            return lines
+        pids = datafax.rangelist.RangeList(1, 281474976710656)
+        pids.fromString(patients)
+        return (line for line in lines \
+                if pids.contains(int(line.split('|', pid_field+1)[pid_field])))
+
+    def plates(self):
+        return ' '.join(self.lines('plates')).split()
+
+    def exportPlate(self, plate, patients):
+        return self.matching(self.lines('plate{0:03d}'.format(int(plate))),
+                patients, 6)
+
+    def auditPartitions(self):
+        '''The dump is a single file, so read it in one pass'''
+        return ['19900101-today']
+
+    def auditTrace(self, dates, patients):
+        (first, last) = dates.split('-')
+        lines = self.matching(self.lines('audit'), patients, 4)
+        if first <= '19900101' and last == 'today':
+            return lines
+        if last == 'today':
+            last = '99999999'
+        return (line for line in lines \
+                if first <= line.split('|', 2)[1] <= last)
+
+#####################################################################
+# SharedStrings - Dictionary encode a repetitive text column. Each
+# distinct string is stored once in its own table and referenced by
+# an integer id.
+#####################################################################
+class SharedStrings(object):
+    def __init__(self, sql, table):
+        self.sql = sql
+        self.table = table
+        sql.execute('create table if not exists ' + table + \
+                ' (id integer primary key, string text)')
+        # Pick up any strings stored by an interrupted build
+        self.strings = dict((s, ssid) for (ssid, s) in \
+                sql.execute('select id, string from ' + table))
+
+    def id(self, s):
+        ssid = self.strings.get(s)
+        if ssid is None:
+            ssid = len(self.strings)
+            self.strings[s] = ssid
+            self.sql.execute('insert into ' + self.table + ' values(?, ?)',
+                    (ssid, s))
+        return ssid
+
+#####################################################################
+# Convert audit trail date (YYYYMMDD) and time (HHMMSS) to seconds
+# since the epoch. Audit times are server local and are kept as-is,
+# so they are treated as UTC to make the conversion reversible.
+#####################################################################
+def to_epoch(date, time):
+    return calendar.timegm((int(date[0:4]), int(date[4:6]), int(date[6:8]),
+        int(time[0:2]), int(time[2:4]), int(time[4:6]), 0, 0, 0))
 
 def potential_deleted(sql, pid, visit, plate, level, reason, force_update):
     data_cursor = sql.execute(
@@ -65,49 +229,29 @@ def potential_deleted(sql, pid, visit, plate, level, reason, force_update):
     else:
         #print('{0} {1} {2} new deletion reason'.format(pid,visit,plate))
         data_cursor = sql.execute(
-                    'insert into deleted values(?, ?, ?, ?, ?);',
+                    'insert into deleted(pid, visit, plate, level, data) values(?, ?, ?, ?, ?);',
                     (pid, visit, plate, level, record))
 
 
-def main():
-    sstrings = {}
-    ssid_seq = 0
-    study_num = None
-    patients = None
-    db = 'data.db'
-
-    try:
-        opts, args = getopt.getopt(sys.argv[1:], 's:d:I:',
-            ['study=', 'db=', 'ids=', 'version'])
-    except getopt.GetoptError, err:
-        print(err)
-        sys.exit(2)
-
-    for o,a in opts:
-        if o in ('-s', '--study'):
-            study_num = int(a)
-        if o in ('-d', '--db'):
-            db = a
-        if o in ('-I', '--ids'):
-            patients = a
-        if o == '--version':
-            print(datafax.__version__)
-            sys.exit(0)
-
-    if study_num is None:
-        print('No study specified')
-        sys.exit(2)
-
-    sql = sqlite3.connect(db)
-    sql.execute('''pragma page_size=4096''')
-    sql.execute('''pragma cache_size=40000''')
-    sql.execute('''pragma locking_mode=EXCLUSIVE''')
-    sql.execute('''pragma synchronous=OFF''')
+#####################################################################
+# Create the database tables, dropping any from a previous build
+#####################################################################
+def create_tables(sql, settings):
     sql.execute('''drop table if exists data''')
     sql.execute('''drop table if exists deleted''')
     sql.execute('''drop table if exists secondaries''')
+    sql.execute('''drop view if exists audit_view''')
     sql.execute('''drop table if exists audit''')
     sql.execute('''drop table if exists shared_strings''')
+    sql.execute('''drop table if exists who_strings''')
+    sql.execute('''drop table if exists code_strings''')
+    sql.execute('''drop table if exists reason_strings''')
+    sql.execute('''drop table if exists valdec_strings''')
+    sql.execute('''drop table if exists checkpoints''')
+    sql.execute('''drop table if exists build_info''')
+    sql.execute('''drop table if exists patients_ready''')
+    sql.execute('''drop table if exists audit_txn''')
+    sql.execute('''drop table if exists field_values''')
     sql.execute('''create table data (
         pid int not null,
         visit int not null,
@@ -120,6 +264,10 @@ def main():
         plate int not null,
         level int not null,
         data text)''')
+    # Closeout's order for each patient's records, from the visit map
+    if settings['display_order']:
+        sql.execute('''alter table data add column display_order int''')
+        sql.execute('''alter table deleted add column display_order int''')
     sql.execute('''create table secondaries (
         pid int not null,
         visit int not null,
@@ -130,87 +278,196 @@ def main():
         visit int not null,
         plate int not null,
         op text not null,
-        tdate text not null,
-        ttime text not null,
-        who text not null,
+        tstamp int not null,
+        whoid int not null,
         type text not null,
         status int not null,
         level int not null,
-        code text,
-        reason text,
+        codeid int not null,
+        reasonid int not null,
         metafnum int not null,
         funiqueid int not null,
         fnum int not null,
         fdescid int not null,
         oldval text,
         newval text,
-        oldvaldec text,
-        newvaldec text
+        oldvaldecid int not null,
+        newvaldecid int not null
         )''')
-    sql.execute('''create table shared_strings (
-        id int not null primary key,
-        string text)''')
-    print('Reading data...')
 
-    datafax_dir = os.getenv('DATAFAX_DIR', '/opt/datafax')
+    # Present the audit table in its original, decoded column layout
+    sql.execute('''create view audit_view as
+        select a.pid, a.visit, a.plate, a.op,
+            strftime('%Y%m%d', a.tstamp, 'unixepoch') as tdate,
+            strftime('%H%M%S', a.tstamp, 'unixepoch') as ttime,
+            w.string as who, a.type, a.status, a.level,
+            c.string as code, r.string as reason,
+            a.metafnum, a.funiqueid, a.fnum, a.fdescid,
+            a.oldval, a.newval,
+            o.string as oldvaldec, n.string as newvaldec
+        from audit a
+        join who_strings w on a.whoid = w.id
+        join code_strings c on a.codeid = c.id
+        join reason_strings r on a.reasonid = r.id
+        join valdec_strings o on a.oldvaldecid = o.id
+        join valdec_strings n on a.newvaldecid = n.id''')
 
-    # Get a list of plate numbers
-    proc = subprocess.Popen([
-        os.path.join(datafax_dir, 'bin', 'DFlistplates.rpc'),
-        '-s', str(study_num)], stdout=subprocess.PIPE)
-    plates = proc.stdout.read().split()
-    proc.wait()
+    # Completed plate exports and audit partitions, so that an interrupted
+    # build can be resumed
+    sql.execute('''create table checkpoints (
+        stage text not null,
+        part text not null,
+        primary key (stage, part))''')
 
-    # Read data records
-    for p in plates:
-        print('  ', p)
-        if patients:
-            params = [os.path.join(datafax_dir, 'bin', 'DFexport.rpc'),
-                    '-s', 'lost,primary,secondary', '-I', patients,
-                    str(study_num), p, '-']
-        else:
-            params = [os.path.join(datafax_dir, 'bin', 'DFexport.rpc'),
-                    '-s', 'lost,primary,secondary', str(study_num), p, '-']
-        proc = subprocess.Popen(params, stdout=subprocess.PIPE)
-        for data in proc.stdout:
-            data = to_unicode(data)
-            data = data.rstrip('\n')
-            fields = data.split('|')
-
-            pid = int(fields[6])
-            visit = int(fields[5])
-            plate = int(fields[4])
-            status = int(fields[0])
-            level = int(fields[1])
-            raster = fields[2]
-
-            if status <= 3:
-                sql.execute('''insert into data values(?, ?, ?, ?, ?)''', \
-                    (pid, visit, plate, level, data))
-            elif raster[4] == '/':
-                sql.execute('''insert into secondaries values(?, ?, ?, ?)''',
-                    (pid, visit, plate, fields[2]))
-        sql.commit()
-    proc.wait()
+    # Parameters of the build, so that a resume continues the same build
+    sql.execute('''create table build_info (
+        name text not null primary key,
+        value text)''')
+    sql.executemany('''insert into build_info values(?, ?)''',
+            settings.items())
 
-    print('Creating index on data...')
-    sql.execute('''create index data_keys on data(pid, visit, plate)''')
-    sql.execute('''create index deleted_keys on deleted(pid, visit, plate)''')
-    sql.execute('''create index secondary_keys on secondaries(pid, visit, plate)''')
+    # Patients whose records and audit trail are completely loaded. A
+    # pipelined build publishes them batch by batch so closeout can start
+    # on them while the rest of the study is still being read.
+    sql.execute('''create table patients_ready (
+        pid integer primary key)''')
 
-    print('Reading audit information...')
-    if patients:
-        params = [os.path.join(datafax_dir, 'bin', 'DFaudittrace'),
-            '-s', str(study_num),
-            '-I', patients, '-d', '19900101-today', '-N', '-q', '-r']
-    else:
-        params = [os.path.join(datafax_dir, 'bin', 'DFaudittrace'),
-            '-s', str(study_num),
-            '-d', '19900101-today', '-N', '-q', '-r']
-    proc = subprocess.Popen(params, stdout=subprocess.PIPE)
-    for data in proc.stdout:
-        data = to_unicode(data)
-        data = data.rstrip('\n')
+    if settings['audit_txn']:
+        create_audit_txn(sql)
+    if settings['field_values']:
+        create_field_values(sql)
+    sql.commit()
+
+#####################################################################
+# Each record's audit trail grouped into transactions and rendered
+# as closeout prints them, with one line per operation in ops
+#####################################################################
+def create_audit_txn(sql):
+    sql.execute('''create table audit_txn (
+        pid int not null,
+        visit int not null,
+        plate int not null,
+        seq int not null,
+        who text,
+        tdate text,
+        ttime text,
+        funiqueid int not null,
+        fnum int not null,
+        desc text,
+        ops text)''')
+    sql.execute('''create index audit_txn_keys
+        on audit_txn(pid, visit, plate, seq)''')
+
+#####################################################################
+# Each non-blank data field of each record, so records can be found
+# by value. Blank fields are left out, as most fields of most plates
+# are blank and a blank value is not something to look records up by.
+#####################################################################
+def create_field_values(sql):
+    sql.execute('''create table field_values (
+        pid int not null,
+        visit int not null,
+        plate int not null,
+        field int not null,
+        value text)''')
+
+def store_field_values(sql, pid, visit, plate, fields):
+    sql.executemany('''insert into field_values values(?, ?, ?, ?, ?)''',
+        [(pid, visit, plate, field, value) for (field, value) \
+            in enumerate(fields[7:], 8) if value])
+
+def index_field_values(sql):
+    sql.execute('''create index if not exists field_values_keys
+        on field_values(plate, field, value, pid, visit)''')
+
+#####################################################################
+# Check whether the database holds an interrupted build of the same
+# study and patients, read the same way
+#####################################################################
+def resumable(sql, settings):
+    try:
+        info = dict(sql.execute('''select name, value from build_info'''))
+    except sqlite3.OperationalError:
+        return False
+    return all([info.get(name) == value for (name, value) in settings.items()])
+
+#####################################################################
+# Checkpoints. Each one is committed in the same transaction as the
+# rows it covers, so an interrupted part leaves nothing behind and is
+# simply redone on resume.
+#####################################################################
+def checkpointed(sql, stage, part):
+    cursor = sql.execute('''select 1 from checkpoints
+        where stage=? and part=?''', (stage, part))
+    return cursor.fetchone() is not None
+
+def checkpoint(sql, stage, part):
+    sql.execute('''insert into checkpoints values(?, ?)''', (stage, part))
+    sql.commit()
+
+#####################################################################
+# The part of an audit partition's date range not yet read. Audit
+# parts are checkpointed under the dates read, so a build resumed after
+# the year it started in reads the rest of that year. Changes made after
+# the interrupted build read a day are left out, as are changes to the
+# data records it had already exported.
+#####################################################################
+def unread_dates(sql, dates):
+    done = dict([part.split('-') for (part,) in sql.execute('''select part
+        from checkpoints where stage='audit' ''') if '-' in part])
+    (first, last) = dates.split('-')
+    while first in done:
+        if done[first] in (last, 'today'):
+            return None
+        day = datetime.datetime.strptime(done[first], '%Y%m%d').date()
+        first = (day + datetime.timedelta(days=1)).strftime('%Y%m%d')
+    return '{0}-{1}'.format(first, last)
+
+#####################################################################
+# Split the loaded patients into batches for a pipelined build
+#####################################################################
+def patient_batches(sql, batch_size):
+    pids = [r[0] for r in sql.execute('''select distinct pid from data
+        order by pid''')]
+    for i in range(0, len(pids), batch_size):
+        yield pids[i:i+batch_size]
+
+#####################################################################
+# Read the data records for a plate
+#####################################################################
+def load_plate(sql, source, plate, patients, compress, field_values):
+    count = 0
+    for data in source.exportPlate(plate, patients):
+        count += 1
+        fields = data.split('|')
+
+        pid = int(fields[6])
+        visit = int(fields[5])
+        plate_num = int(fields[4])
+        status = int(fields[0])
+        level = int(fields[1])
+        raster = fields[2]
+
+        if status <= 3:
+            if field_values:
+                store_field_values(sql, pid, visit, plate_num, fields)
+            if compress:
+                data = closeoutdb.pack(data)
+            sql.execute('''insert into data(pid, visit, plate, level, data)
+                values(?, ?, ?, ?, ?)''', \
+                (pid, visit, plate_num, level, data))
+        elif raster[4] == '/':
+            sql.execute('''insert into secondaries values(?, ?, ?, ?)''',
+                (pid, visit, plate_num, fields[2]))
+    return count
+
+#####################################################################
+# Read the audit trail for a date range
+#####################################################################
+def load_audit(sql, strings, source, dates, patients, compress):
+    count = 0
+    for data in source.auditTrace(dates, patients):
+        count += 1
         (op, date, time, who, pid, visit, plate, uniqueid, metafnum, \
                 status, level, maxlevel, codevalue, codetext, oldval, newval, \
                 fnum, fdesc, dec_oldval, dec_newval) = data.split('|')
@@ -228,32 +485,581 @@ def main():
             uniqueid = int(metafnum)
             metafnum = '0'
 
-        # Used shared strings for field descriptions to reduce size of DB
-        ssid = sstrings.get(fdesc)
-        if ssid == None:
-            sstrings[fdesc] = ssid_seq
-            sql.execute('''insert into shared_strings values(?, ?)''',
-                    (ssid_seq, fdesc))
-            ssid = ssid_seq
-            ssid_seq += 1
+        if compress:
+            oldval = closeoutdb.pack(oldval)
+            newval = closeoutdb.pack(newval)
 
-        sql.execute('''insert into audit values(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''', \
-                (pid, visit, plate, op, date, time, who, rec_type, status, \
-                    level, codevalue, codetext, metafnum, uniqueid, fnum, \
-                    ssid, oldval, newval, dec_oldval, dec_newval))
+        sql.execute('''insert into audit values(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''', \
+                (pid, visit, plate, op, to_epoch(date, time), \
+                    strings['who'].id(who), rec_type, status, level, \
+                    strings['code'].id(codevalue), \
+                    strings['reason'].id(codetext), metafnum, uniqueid, fnum, \
+                    strings['fdesc'].id(fdesc), oldval, newval, \
+                    strings['valdec'].id(dec_oldval), \
+                    strings['valdec'].id(dec_newval)))
 
         # Keep track of deleted record reasons
         if rec_type == 'r' and uniqueid < 5100 and metafnum == '0':
             potential_deleted(sql, pid, visit, plate, level, codetext, True)
         if rec_type == 'd' and fnum == '' and status == '7':
             potential_deleted(sql, pid, visit, plate, level, '', False)
+    return count
+
+#####################################################################
+# Group the audit trail of each record of the patients from first to
+# last into the transactions closeout prints
+#####################################################################
+def store_audit_txn(sql, trail, first, last):
+    count = 0
+    keys = sql.execute('''select distinct pid, visit, plate from audit
+        where pid between ? and ?''', (first, last)).fetchall()
+    for (pid, visit, plate) in keys:
+        rows = sql.execute(closeoutdb.AUDIT_SELECT,
+                (pid, visit, plate)).fetchall()
+        for (seq, txn) in enumerate(trail.transactions(rows)):
+            sql.execute('''insert into audit_txn
+                values(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+                (pid, visit, plate, seq, txn.who, txn.tdate, txn.ttime,
+                    txn.funiqueid, txn.fnum, txn.desc, '\n'.join(txn.ops)))
+            count += 1
+    return count
+
+#####################################################################
+# Number the records of table that have no display order yet in the
+# order closeout prints a patient's records. sqlite3 commits before DDL,
+# so the temp table they are looked up in is created once, before any
+# checkpointed part.
+#####################################################################
+def create_display_orders(sql):
+    sql.execute('''create temp table if not exists display_orders (
+        visit int not null,
+        plate int not null,
+        display_order int not null,
+        primary key (visit, plate))''')
+
+def set_display_order(sql, visitmap, table):
+    keys = sql.execute('''select distinct visit, plate from {0}
+        where display_order is null'''.format(table)).fetchall()
+    sql.executemany('''insert or replace into temp.display_orders
+        values(?, ?, ?)''', [(visit, plate,
+            closeoutdb.displayOrder(visitmap, visit, plate)) \
+            for (visit, plate) in keys])
+    sql.execute('''update {0} set display_order=(
+        select o.display_order from temp.display_orders o
+        where o.visit={0}.visit and o.plate={0}.plate)
+        where display_order is null'''.format(table))
 
+#####################################################################
+# Reorder the records of an existing database, after the visit map
+# has changed
+#####################################################################
+def reorder(sql, visitmap):
+    closeoutdb.migrate(sql)
+    create_display_orders(sql)
+    for table in ('data', 'deleted'):
+        columns = [r[1] for r in sql.execute(
+            'pragma table_info({0})'.format(table))]
+        if 'display_order' not in columns:
+            sql.execute('''alter table {0} add column display_order int
+                '''.format(table))
+        sql.execute('''update {0} set display_order=null'''.format(table))
+        set_display_order(sql, visitmap, table)
+    sql.execute('''create index if not exists data_display_order
+        on data(pid, display_order, visit, plate, level)''')
+    sql.execute('''create index if not exists deleted_display_order
+        on deleted(pid, display_order, visit, plate, level)''')
+    sql.execute('''insert or replace into build_info
+        values('display_order', '1')''')
+    sql.execute('''analyze''')
     sql.commit()
-    proc.wait()
 
+#####################################################################
+# Upgrade an existing database to the current schema version, and
+# add the audit transactions and field values tables if requested
+#####################################################################
+def upgrade(sql, trail, txn_studydir, field_values):
+    version = closeoutdb.Schema(sql).version
+    for target in closeoutdb.migrate(sql):
+        print('   schema version {0} -> {1}'.format(version, target))
+        version = target
+
+    # Audit transactions grouped with a different study setup, or before
+    # the setup was recorded, are grouped again
+    schema = closeoutdb.Schema(sql)
+    digest = closeoutdb.setupDigest(txn_studydir) if trail else None
+    if trail and closeoutdb.buildInfo(sql).get('audit_txn_setup') != digest:
+        print('   grouping audit transactions')
+        if schema.has('audit_txn'):
+            sql.execute('''drop table audit_txn''')
+        create_audit_txn(sql)
+        store_audit_txn(sql, trail, 0, 281474976710656)
+        sql.executemany('''insert or replace into build_info values(?, ?)''',
+            [('audit_txn', txn_studydir), ('audit_txn_setup', digest)])
+        sql.commit()
+
+    if field_values and not schema.has('field_values'):
+        print('   storing field values')
+        create_field_values(sql)
+        for (pid, visit, plate, data) in sql.execute('''select pid, visit,
+                plate, data from data''').fetchall():
+            store_field_values(sql, pid, visit, plate,
+                closeoutdb.unpack(data).split('|'))
+        index_field_values(sql)
+        sql.execute('''insert or replace into build_info
+            values('field_values', '1')''')
+        sql.commit()
+
+    sql.execute('''analyze''')
+    for (query, detail) in closeoutdb.checkQueryPlans(sql):
+        print('WARNING: {0} query is not index-only: {1}'.format(query, detail))
+    sql.commit()
+
+#####################################################################
+# Report how quickly records were processed
+#####################################################################
+def report_rate(what, count, start):
+    elapsed = time.time() - start
+    print('{0} {1} in {2:.1f}s ({3:.0f}/s)'.format(count, what, elapsed,
+        count/elapsed if elapsed else 0))
+
+#####################################################################
+# Load the data and audit records from the source, checkpointing each
+# plate and audit partition as it completes
+#####################################################################
+def build(sql, strings, source, patients, batch_size, trail, compress,
+        field_values, visitmap):
+    if visitmap:
+        create_display_orders(sql)
+
+    print('Reading data...')
+
+    # Read data records
+    start = time.time()
+    count = 0
+    for p in source.plates():
+        if checkpointed(sql, 'plate', p):
+            continue
+        print('  ', p)
+        count += load_plate(sql, source, p, patients, compress,
+                field_values)
+        checkpoint(sql, 'plate', p)
+    report_rate('data records read', count, start)
+
+    if visitmap:
+        print('Ordering data records...')
+        set_display_order(sql, visitmap, 'data')
+        sql.commit()
+
+    print('Creating index on data...')
+    sql.execute('''create index if not exists data_keys
+        on data(pid, visit, plate)''')
+    sql.execute('''create index if not exists deleted_keys
+        on deleted(pid, visit, plate)''')
+    sql.execute('''create index if not exists secondary_keys
+        on secondaries(pid, visit, plate, raster)''')
+
+    # Covering index for closeout's patient list
+    sql.execute('''create index if not exists data_pid_level
+        on data(pid, level, visit, plate)''')
+
+    # Closeout reads each patient's records in display order
+    if visitmap:
+        sql.execute('''create index if not exists data_display_order
+            on data(pid, display_order, visit, plate, level)''')
+        sql.execute('''create index if not exists deleted_display_order
+            on deleted(pid, display_order, visit, plate, level)''')
+
+    # Covering index to find the records having a field value
+    if field_values:
+        index_field_values(sql)
+
+    # DFaudittrace reads the journals of the whole study however few
+    # patients are asked for, so the audit trail is read in one pass of
+    # its date partitions, even by a pipelined build
+    print('Reading audit information...')
+    start = time.time()
+    count = 0
+    for dates in source.auditPartitions():
+        dates = unread_dates(sql, dates)
+        if dates is None:
+            continue
+        print('  ', dates)
+        count += load_audit(sql, strings, source, dates, patients, compress)
+        checkpoint(sql, 'audit', dates)
+
+    if visitmap:
+        set_display_order(sql, visitmap, 'deleted')
+
+    # Index on the columns closeout selects and sorts audit rows by. Rows
+    # with the same time stay in the order they were read. Covering every
+    # column would store the audit trail twice.
     print('Creating index on audit table...')
-    sql.execute('''create index audit_keys on audit(pid, visit, plate)''')
-    sql.close()
+    sql.execute('''create index if not exists audit_keys on audit(pid,
+        visit, plate, tstamp)''')
+    sql.commit()
+    report_rate('audit records read', count, start)
+
+    # A pipelined build publishes each batch of patients as soon as their
+    # audit transactions are grouped, so closeout can start on them
+    if batch_size:
+        print('Publishing patients...')
+        for batch in patient_batches(sql, batch_size):
+            part = '{0}-{1}'.format(batch[0], batch[-1])
+            if checkpointed(sql, 'ready', part):
+                continue
+            print('   patients', part)
+            if trail:
+                store_audit_txn(sql, trail, batch[0], batch[-1])
+            sql.executemany('''insert into patients_ready values(?)''',
+                    [(pid,) for pid in batch])
+            checkpoint(sql, 'ready', part)
+    else:
+        if trail and not checkpointed(sql, 'audit_txn', 'all'):
+            print('Grouping audit transactions...')
+            start = time.time()
+            count = store_audit_txn(sql, trail, 0, 281474976710656)
+            checkpoint(sql, 'audit_txn', 'all')
+            report_rate('audit transactions stored', count, start)
+
+        sql.execute('''insert or ignore into patients_ready
+            select distinct pid from data''')
+
+#####################################################################
+# Assign each patient to a shard, by site or by a hash of the patient
+# ID. Returns the site of each site shard.
+#####################################################################
+def assign_shards(sql, shard_by, study):
+    sql.execute('''create temp table shard_map (
+        pid integer primary key,
+        shard text not null)''')
+    pids = [r[0] for r in sql.execute('''select pid from data
+        union select pid from deleted''')]
+    sites = {}
+    if shard_by == 'site':
+        centerdb = study.Centers()
+        for pid in pids:
+            site = centerdb.centerNumber(pid)
+            shard = 'site{0}'.format(site)
+            sites[shard] = site
+            sql.execute('''insert into shard_map values(?, ?)''', (pid, shard))
+    else:
+        buckets = int(shard_by.split(':')[1])
+        for pid in pids:
+            bucket = (zlib.crc32(str(pid)) & 0xffffffff) % buckets
+            sql.execute('''insert into shard_map values(?, ?)''',
+                    (pid, 'bucket{0:03d}'.format(bucket)))
+    return sites
+
+#####################################################################
+# Copy one shard's patients into a database of its own, with the same
+# tables, indexes and views. Tables without a pid column (the string
+# dictionaries and build information) are copied whole.
+#####################################################################
+def write_shard(sql, shard, path):
+    if os.path.exists(path):
+        os.remove(path)
+    schema = sql.execute('''select type, name, sql from main.sqlite_master
+        where sql is not null and name not like 'sqlite_%' ''').fetchall()
+
+    shard_sql = sqlite3.connect(path)
+    shard_sql.execute('''pragma page_size=4096''')
+    for (kind, name, ddl) in schema:
+        if kind == 'table':
+            shard_sql.execute(ddl)
+    shard_sql.commit()
+    shard_sql.close()
+
+    sql.execute('''attach database ? as shard''', (path,))
+    sql.execute('''pragma shard.synchronous=OFF''')
+    for (kind, name, ddl) in schema:
+        if kind != 'table':
+            continue
+        columns = [r[1] for r in sql.execute('pragma table_info({0})'.format(
+            name))]
+        if 'pid' in columns:
+            sql.execute('''insert into shard.{0} select * from main.{0}
+                where pid in (select pid from temp.shard_map where shard=?)
+                '''.format(name), (shard,))
+        else:
+            sql.execute('''insert into shard.{0} select * from main.{0}
+                '''.format(name))
+    sql.execute('''insert or replace into shard.build_info
+        values('shard', ?)''', (shard,))
+    sql.commit()
+    sql.execute('''detach database shard''')
+
+    shard_sql = sqlite3.connect(path)
+    for (kind, name, ddl) in schema:
+        if kind != 'table':
+            shard_sql.execute(ddl)
+    shard_sql.execute('''analyze''')
+    shard_sql.commit()
+    shard_sql.close()
+
+#####################################################################
+# Split a completed build into shards, and list them in the catalog
+#####################################################################
+def split_shards(sql, shard_by, study, catalog):
+    print('Splitting into shards...')
+    sites = assign_shards(sql, shard_by, study)
+    stem = os.path.splitext(catalog)[0]
+
+    if os.path.exists(catalog):
+        os.remove(catalog)
+    catalog_sql = sqlite3.connect(catalog)
+    catalog_sql.execute('''create table shards (
+        name text not null primary key,
+        path text not null,
+        site int,
+        patients int not null)''')
+    catalog_sql.execute('''create table patients (
+        pid integer primary key,
+        shard text not null)''')
+    catalog_sql.execute('''create index patients_shard
+        on patients(shard, pid)''')
+    catalog_sql.execute('''create table build_info (
+        name text not null primary key,
+        value text)''')
+    catalog_sql.executemany('''insert into build_info values(?, ?)''',
+        sql.execute('''select name, value from build_info'''))
+    catalog_sql.execute('''insert or replace into build_info
+        values('shard_by', ?)''', (shard_by,))
+
+    shards = sql.execute('''select shard, count(*) from temp.shard_map
+        group by shard order by shard''').fetchall()
+    for (shard, count) in shards:
+        print('  ', shard)
+        path = '{0}-{1}.db'.format(stem, shard)
+        write_shard(sql, shard, path)
+        # Shards are found relative to the catalog
+        catalog_sql.execute('''insert into shards values(?, ?, ?, ?)''',
+            (shard, os.path.basename(path), sites.get(shard), count))
+    catalog_sql.executemany('''insert into patients values(?, ?)''',
+        sql.execute('''select pid, shard from temp.shard_map'''))
+    catalog_sql.commit()
+    catalog_sql.close()
+
+def main():
+    study_num = None
+    patients = None
+    resume = False
+    batch_size = None
+    source_dir = None
+    use_mmap = False
+    studydir = None
+    audit_txn = False
+    shard_by = None
+    compress = False
+    field_values = False
+    reorder_only = False
+    upgrade_only = False
+    db = 'data.db'
+
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 's:d:I:',
+            ['study=', 'db=', 'ids=', 'resume', 'pipelined', 'batch-size=',
+             'source=', 'mmap', 'studydir=', 'audit-txn',
+             'shard-by=', 'compress', 'field-values', 'reorder',
+             'upgrade', 'version'])
+    except getopt.GetoptError, err:
+        print(err)
+        sys.exit(2)
+
+    for o,a in opts:
+        if o in ('-s', '--study'):
+            study_num = int(a)
+        if o in ('-d', '--db'):
+            db = a
+        if o in ('-I', '--ids'):
+            patients = a
+        if o == '--resume':
+            resume = True
+        if o == '--pipelined' and batch_size is None:
+            batch_size = 100
+        if o == '--batch-size':
+            batch_size = int(a)
+        if o == '--source':
+            source_dir = a
+        if o == '--mmap':
+            use_mmap = True
+        if o == '--studydir':
+            studydir = a
+        if o == '--audit-txn':
+            audit_txn = True
+        if o == '--shard-by':
+            shard_by = a
+        if o == '--compress':
+            compress = True
+        if o == '--field-values':
+            field_values = True
+        if o == '--reorder':
+            reorder_only = True
+        if o == '--upgrade':
+            upgrade_only = True
+        if o == '--version':
+            print(datafax.__version__)
+            sys.exit(0)
+
+    if reorder_only:
+        if not studydir:
+            print('--reorder requires --studydir')
+            sys.exit(2)
+        if not os.path.exists(db):
+            print('Database {0} does not exist'.format(db))
+            sys.exit(2)
+        study = datafax.Study()
+        study.loadFromFiles(studydir)
+        print('Reordering records...')
+        sql = sqlite3.connect(db)
+        reorder(sql, study.visitMap())
+        sql.close()
+        print('Done.')
+        sys.exit(0)
+
+    # Bring a database, or each shard of a catalog, up to date in place
+    if upgrade_only:
+        if audit_txn and not studydir:
+            print('--audit-txn requires --studydir')
+            sys.exit(2)
+        trail = None
+        if audit_txn:
+            study = datafax.Study()
+            study.loadFromFiles(studydir)
+            trail = audittrail.AuditTrail(study)
+        if not os.path.exists(db):
+            print('Database {0} does not exist'.format(db))
+            sys.exit(2)
+        sql = sqlite3.connect(db)
+        if closeoutdb.buildInfo(sql).get('shard_by'):
+            paths = closeoutdb.shardPaths(db, None, None, None)
+        else:
+            paths = [db]
+        try:
+            for path in paths:
+                print('Upgrading {0}...'.format(path))
+                shard_sql = sqlite3.connect(path)
+                upgrade(shard_sql, trail, studydir, field_values)
+                shard_sql.close()
+        except ValueError, err:
+            print(err)
+            sys.exit(1)
+        if paths != [db]:
+            sql.execute('''insert or replace into build_info
+                values('schema_version', ?)''',
+                (str(closeoutdb.SCHEMA_VERSION),))
+            sql.commit()
+        sql.close()
+        print('Done.')
+        sys.exit(0)
+
+    if study_num is None:
+        print('No study specified')
+        sys.exit(2)
+
+    if shard_by and shard_by != 'site' and \
+            not (shard_by.startswith('bucket:') and shard_by[7:].isdigit() and
+            int(shard_by[7:]) > 0):
+        print('--shard-by must be site or bucket:N')
+        sys.exit(2)
+
+    if (audit_txn or shard_by == 'site') and not studydir:
+        print('--audit-txn and --shard-by=site require --studydir')
+        sys.exit(2)
+
+    # With the study setup, records are put in display order as well
+    study = None
+    visitmap = None
+    if studydir:
+        study = datafax.Study()
+        study.loadFromFiles(studydir)
+        visitmap = study.visitMap()
+
+    # Audit transactions are rendered with the study's setup
+    trail = None
+    txn_studydir = None
+    if audit_txn:
+        trail = audittrail.AuditTrail(study)
+        txn_studydir = studydir
+
+    # A sharded build is staged in a database of its own, which is split
+    # into the shards once it is complete. The -d database is the catalog.
+    catalog = None
+    if shard_by:
+        catalog = db
+        db = os.path.splitext(catalog)[0] + '-build.db'
+
+    if source_dir:
+        source = DumpSource(source_dir, use_mmap)
+    else:
+        source = RPCSource(study_num)
+
+    sql = sqlite3.connect(db)
+    sql.execute('''pragma page_size=4096''')
+    sql.execute('''pragma cache_size=40000''')
+    if batch_size:
+        # Pipelined builds let closeout read the database while it is
+        # being written
+        sql.execute('''pragma journal_mode=WAL''')
+        sql.execute('''pragma synchronous=NORMAL''')
+    else:
+        sql.execute('''pragma locking_mode=EXCLUSIVE''')
+        sql.execute('''pragma synchronous=OFF''')
+
+    # Build settings, recorded in build_info and compared by --resume
+    settings = {
+        'schema_version': str(closeoutdb.SCHEMA_VERSION),
+        'study': str(study_num),
+        'ids': patients or '',
+        'batch_size': str(batch_size or ''),
+        'source': source.description(),
+        'audit_txn': txn_studydir or '',
+        'audit_txn_setup': closeoutdb.setupDigest(txn_studydir)
+            if txn_studydir else '',
+        'compress': 'zlib' if compress else '',
+        'field_values': '1' if field_values else '',
+        'display_order': '1' if visitmap else '',
+    }
+    if resume and resumable(sql, settings):
+        print('Resuming previous build...')
+    else:
+        if resume:
+            print('No matching build to resume, starting a new build')
+        create_tables(sql, settings)
+
+    # Dictionary encode the repetitive audit columns to reduce size of DB
+    strings = {
+        'fdesc': SharedStrings(sql, 'shared_strings'),
+        'who': SharedStrings(sql, 'who_strings'),
+        'code': SharedStrings(sql, 'code_strings'),
+        'reason': SharedStrings(sql, 'reason_strings'),
+        'valdec': SharedStrings(sql, 'valdec_strings'),
+    }
+    try:
+        build(sql, strings, source, patients, batch_size, trail, compress,
+                field_values, visitmap)
+    except SourceError, err:
+        sql.rollback()
+        sql.close()
+        print(err)
+        print('Use --resume to continue the build from the last checkpoint')
+        sys.exit(1)
+
+    print('Analyzing tables...')
+    sql.execute('''analyze''')
+
+    print('Checking query plans...')
+    for (query, detail) in closeoutdb.checkQueryPlans(sql):
+        print('WARNING: {0} query is not index-only: {1}'.format(query, detail))
+
+    sql.execute('''insert or replace into build_info values('complete', '1')''')
+    sql.commit()
+
+    if shard_by:
+        split_shards(sql, shard_by, study, catalog)
+        sql.close()
+        os.remove(db)
+    else:
+        sql.close()
     print('Done.')
 
 if __name__ == "__main__":
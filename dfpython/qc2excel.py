@@ -28,6 +28,7 @@ import os
 import getopt
 import codecs
 import datafax
+from datafax.streamreader import decodeLines
 import sys
 import xlsxwriter
 import datetime
@@ -39,16 +40,6 @@ from email.mime.text import MIMEText
 from email.utils import formatdate
 from email import encoders
 
-#####################################################################
-# Decode text as Unicode, and if that doesn't work, try Latin-1
-#####################################################################
-def to_unicode(s):
-    try:
-        u = s.decode('utf-8')
-    except UnicodeDecodeError:
-        u = s.decode('latin-1')
-    return u
-
 #####################################################################
 # Load Priorities
 #####################################################################
@@ -460,8 +451,7 @@ def QC2Excel(config):
     print('Populating Data Table...')
     #stdin = codecs.getreader("utf-8")(sys.stdin)
     countries = study.Countries()
-    for qc in sys.stdin:
-        qc = to_unicode(qc)
+    for qc in decodeLines(sys.stdin):
         qcf = qc.split('|')
 
         center_num = int(qcf[8])